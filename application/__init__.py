@@ -1,17 +1,15 @@
 """Main module for the fastapi app."""
-import pathlib
-
-from dotenv import load_dotenv
 from fastapi import FastAPI
 
 import application.mongo as mongo
 import application.routers as routers
 
-# load the environment from the file app.env in the project directory
-basedir = pathlib.Path(__file__).parent.parent
-load_dotenv(basedir / "app.env")
-
 app = FastAPI()
 
 app.include_router(routers.router)
 app.add_event_handler("startup", mongo.backend)
+app.add_event_handler("startup", mongo.start_invalidation_bus)
+app.add_event_handler("startup", routers.build_autocomplete_indexes)
+app.add_event_handler("startup", routers.warm_up)
+app.add_event_handler("shutdown", mongo.stop_invalidation_bus)
+app.add_event_handler("shutdown", mongo.close_backend)
@@ -0,0 +1,65 @@
+"""Module for completing book titles and author names from memory."""
+import bisect
+from collections import Counter
+from typing import Iterable, List, Tuple
+
+
+class PrefixIndex:
+    """Sorted array of names searched with bisect, ignoring case.
+
+    A name is kept as long as it was added more often than it was removed, so
+    names shared by several books can be added and removed once per book.
+    """
+
+    def __init__(self) -> None:
+        self._entries: List[Tuple[str, str]] = []
+        self._counts: Counter = Counter()
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        return name.casefold()
+
+    def add(self, name: str) -> None:
+        self._counts[name] += 1
+        if self._counts[name] == 1:
+            bisect.insort(self._entries, (self.normalize(name), name))
+
+    def add_many(self, names: Iterable[str]) -> None:
+        new_names = []
+        for name in names:
+            self._counts[name] += 1
+            if self._counts[name] == 1:
+                new_names.append((self.normalize(name), name))
+        if new_names:
+            self._entries.extend(new_names)
+            self._entries.sort()
+
+    def remove(self, name: str) -> None:
+        if name not in self._counts:
+            return
+        self._counts[name] -= 1
+        if self._counts[name] > 0:
+            return
+        del self._counts[name]
+        entry = (self.normalize(name), name)
+        index = bisect.bisect_left(self._entries, entry)
+        if index < len(self._entries) and self._entries[index] == entry:
+            del self._entries[index]
+
+    def complete(self, prefix: str, limit: int) -> List[str]:
+        """Get at most `limit` names starting with the prefix, in sorted order."""
+        prefix = self.normalize(prefix)
+        start = bisect.bisect_left(self._entries, (prefix,))
+        names = []
+        for normalized, name in self._entries[start : start + limit]:
+            if not normalized.startswith(prefix):
+                break
+            names.append(name)
+        return names
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._counts.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
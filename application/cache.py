@@ -0,0 +1,335 @@
+"""Module for the caches used by the routes."""
+import asyncio
+import functools
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+)
+
+import bson
+from bson.errors import InvalidBSON
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # redis is optional, without it nothing is shared between workers
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Number of invalidations applied by this worker. A value read before one of
+# them must not be cached after it, and a call made after one of them must not
+# join a call started before it.
+GENERATION = 0
+
+
+def make_key(value: Any) -> Hashable:
+    """Turn the lists and dicts of arguments into something hashable."""
+    if isinstance(value, (list, tuple)):
+        return tuple(make_key(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, make_key(item)) for key, item in value.items()))
+    return value
+
+
+def bump_generation() -> None:
+    global GENERATION
+    GENERATION += 1
+
+
+def single_flight(
+    method: Callable[..., Awaitable[Any]]
+) -> Callable[..., Awaitable[Any]]:
+    """Share one call of a coroutine method between identical concurrent calls.
+
+    The call runs in its own task so it survives the cancellation of any of the
+    callers. All callers get the same result object, which must not be mutated.
+    Calls are only shared within a generation, a call started before an
+    invalidation may return what the invalidation made stale.
+    """
+    calls: Dict[Hashable, asyncio.Future] = {}
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        key = (GENERATION, id(self), make_key(args), make_key(kwargs))
+        task = calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(method(self, *args, **kwargs))
+            calls[key] = task
+
+            def forget(_):
+                if calls.get(key) is task:
+                    del calls[key]
+
+            task.add_done_callback(forget)
+        return await asyncio.shield(task)
+
+    return wrapper
+
+
+CountCacheKey = Tuple[
+    Optional[Tuple[str, ...]], Optional[Tuple[str, ...]], Optional[datetime]
+]
+
+
+class LRUCache:
+    """Least recently used cache whose entries expire `ttl` seconds after being set."""
+
+    def __init__(
+        self,
+        maxsize: int = 128,
+        ttl: float = 60,
+        timer: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._timer = timer
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= self._timer():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (value, self._timer() + self._ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class CountCache(LRUCache):
+    """Cache for the number of books matching a filter.
+
+    Writes only evict the entries whose filter matches one of the books written.
+    """
+
+    @staticmethod
+    def key(
+        authors: Optional[Tuple[str, ...]] = None,
+        genres: Optional[Tuple[str, ...]] = None,
+        published_year: Optional[datetime] = None,
+    ) -> CountCacheKey:
+        return authors, genres, published_year
+
+    @staticmethod
+    def matches(key: CountCacheKey, book: Dict[str, Any]) -> bool:
+        authors, genres, published_year = key
+        if authors is not None and book.get("author") not in authors:
+            return False
+        if genres is not None and not set(book.get("genres", [])).intersection(genres):
+            return False
+        if published_year is not None and book.get("published_year") != published_year:
+            return False
+        return True
+
+    def invalidate(self, *books: Dict[str, Any]) -> None:
+        """Evict the counts of all the filters that any of the books matches."""
+        for key in list(self._entries):
+            if any(self.matches(key, book) for book in books):
+                del self._entries[key]
+
+
+class SharedCache:
+    """Cache shared by all the workers, behind the in process caches.
+
+    Entries are stored under the version of the catalog. A write bumps the
+    version, which makes every entry stored before it unreachable, instead of
+    finding and deleting the entries it made stale.
+    """
+
+    def __init__(self) -> None:
+        self._version: Optional[int] = None
+
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return [None] * len(keys)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        pass
+
+    async def _get_version(self) -> Optional[int]:
+        return None
+
+    async def _increment_version(self) -> Optional[int]:
+        return None
+
+    async def version(self) -> Optional[int]:
+        """Get the version of the catalog, None when nothing can be shared."""
+        if self._version is None:
+            self._version = await self._get_version()
+        return self._version
+
+    async def bump_version(self) -> None:
+        self._version = await self._increment_version()
+
+    def forget_version(self) -> None:
+        """Read the version again, after a write of another worker bumped it."""
+        self._version = None
+
+
+class NoOpSharedCache(SharedCache):
+    """Shared cache of a single worker, which has nobody to share with."""
+
+
+class RedisSharedCache(SharedCache):
+    """Shared cache stored in anything speaking the Redis protocol.
+
+    Failing commands are logged and treated as misses, the database can always
+    answer instead.
+    """
+
+    VERSION_KEY = "version"
+
+    def __init__(self, client: Any, prefix: str = "books") -> None:
+        super().__init__()
+        self._client = client
+        self._prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisSharedCache":
+        if redis is None:
+            raise RuntimeError("The redis package is needed for a shared cache")
+        return cls(redis.from_url(url))
+
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        try:
+            return await self._client.mget([f"{self._prefix}:{key}" for key in keys])
+        except Exception:
+            logger.exception("Could not read from the shared cache")
+            return [None] * len(keys)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        try:
+            await self._client.set(
+                f"{self._prefix}:{key}", value, px=max(int(ttl * 1000), 1)
+            )
+        except Exception:
+            logger.exception("Could not write to the shared cache")
+
+    async def _get_version(self) -> Optional[int]:
+        try:
+            return int(
+                await self._client.get(f"{self._prefix}:{self.VERSION_KEY}") or 0
+            )
+        except Exception:
+            logger.exception("Could not read the version of the shared cache")
+            return None
+
+    async def _increment_version(self) -> Optional[int]:
+        try:
+            return await self._client.incr(f"{self._prefix}:{self.VERSION_KEY}")
+        except Exception:
+            # Other workers keep the stale entries until they expire
+            logger.exception("Could not bump the version of the shared cache")
+            return None
+
+
+def create_shared_cache(url: str) -> SharedCache:
+    if not url:
+        return NoOpSharedCache()
+    return RedisSharedCache.from_url(url)
+
+
+class TwoTierCache:
+    """In process cache in front of the cache shared by all the workers.
+
+    Removing entries only removes them from the in process cache, the shared
+    cache forgets them when its version is bumped. Values are stored as BSON in
+    the shared cache, anything else in it is treated as a miss.
+    """
+
+    def __init__(
+        self, local: LRUCache, shared: SharedCache, namespace: str, ttl: float
+    ) -> None:
+        self.local = local
+        self._shared = shared
+        self._namespace = namespace
+        self._ttl = ttl
+
+    @staticmethod
+    def _encode(value: Any) -> bytes:
+        return bson.encode({"value": value})
+
+    @staticmethod
+    def _decode(data: bytes) -> Optional[Any]:
+        try:
+            return bson.decode(data)["value"]
+        except (InvalidBSON, KeyError):
+            logger.warning("Ignoring an invalid entry of the shared cache")
+            return None
+
+    def _shared_key(self, key: Hashable, version: int) -> str:
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return f"{self._namespace}:{version}:{digest}"
+
+    async def get(self, key: Hashable) -> Optional[Any]:
+        return (await self.get_many([key]))[0]
+
+    async def get_many(self, keys: List[Hashable]) -> List[Optional[Any]]:
+        values = [self.local.get(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if not missing:
+            return values
+        version = await self._shared.version()
+        if version is None:
+            return values
+        shared_values = await self._shared.get_many(
+            [self._shared_key(key, version) for key in missing]
+        )
+        found = {}
+        for key, data in zip(missing, shared_values):
+            value = self._decode(data) if data is not None else None
+            if value is not None:
+                found[key] = value
+                self.local.set(key, value)
+        return [
+            found.get(key) if value is None else value
+            for key, value in zip(keys, values)
+        ]
+
+    async def set(
+        self, key: Hashable, value: Any, generation: Optional[int] = None
+    ) -> None:
+        """Cache the value, unless it was read before the `generation` changed."""
+        if generation is not None and generation != GENERATION:
+            return
+        self.local.set(key, value)
+        version = await self._shared.version()
+        if version is not None:
+            await self._shared.set(
+                self._shared_key(key, version), self._encode(value), self._ttl
+            )
+
+    def pop(self, key: Hashable) -> None:
+        self.local.pop(key)
+
+    def clear(self) -> None:
+        self.local.clear()
+
+    def __len__(self) -> int:
+        return len(self.local)
@@ -0,0 +1,134 @@
+"""Module for invalidating the caches of every worker after a write.
+
+The write routes deliver a message for every write to the subscribers, which
+apply it to the caches of the worker, then publish it to the other workers. A
+message holds the `added` and the `removed` books, and `clear` when too much
+changed to evict the cached values one by one.
+"""
+import asyncio
+import logging
+import uuid
+from contextlib import suppress
+from typing import Any, Callable, Dict, List, Optional
+
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+
+Message = Dict[str, Any]
+
+SUBSCRIBERS: List[Callable[[Message], None]] = []
+
+logger = logging.getLogger(__name__)
+
+
+def subscribe(callback: Callable[[Message], None]) -> None:
+    SUBSCRIBERS.append(callback)
+
+
+def deliver(message: Message) -> None:
+    for callback in SUBSCRIBERS:
+        callback(message)
+
+
+class InvalidationBus:
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def publish(self, message: Message) -> None:
+        """Send the message to the other workers, this one already applied it."""
+
+
+class InMemoryBus(InvalidationBus):
+    """Bus of a single process, there are no other workers to tell."""
+
+
+class CappedCollectionBus(InvalidationBus):
+    """Bus shared by the workers through a capped collection of mongo.
+
+    Every worker tails the collection and applies the messages published by
+    the other workers. Unlike change streams this works without a replica set.
+    When tailing fails messages may have been missed, so the caches are cleared.
+    """
+
+    def __init__(
+        self, database: Any, collection: str, size: int, retry_delay: float = 1
+    ) -> None:
+        self._database = database
+        self._collection = collection
+        self._size = size
+        self._retry_delay = retry_delay
+        self._origin = uuid.uuid4().hex
+        self._task: Optional[asyncio.Future] = None
+
+    async def start(self) -> None:
+        with suppress(CollectionInvalid):
+            await self._database.create_collection(
+                self._collection, capped=True, size=self._size
+            )
+        self._task = asyncio.ensure_future(self._tail(await self._add_marker()))
+
+    async def _add_marker(self) -> Any:
+        """Add a message to start tailing from.
+
+        A tailable cursor also dies at once on an empty collection, which the
+        marker prevents.
+        """
+        result = await self._database[self._collection].insert_one(
+            {"origin": self._origin, "message": None}
+        )
+        return result.inserted_id
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def publish(self, message: Message) -> None:
+        await self._database[self._collection].insert_one(
+            {"origin": self._origin, "message": message}
+        )
+
+    async def _tail(self, last_id: Any) -> None:
+        """Apply the messages of the other workers published after `last_id`.
+
+        Ids of different workers are not ordered, so the cursor reads the
+        collection in insertion order and skips everything up to `last_id`.
+        """
+        collection = self._database[self._collection]
+        cursor = None
+        while True:
+            try:
+                if cursor is None or not cursor.alive:
+                    if cursor is not None:
+                        await asyncio.sleep(self._retry_delay)
+                    if await collection.find_one({"_id": last_id}) is None:
+                        # Newer messages overwrote it, some may have been missed
+                        logger.warning("Lost invalidations, clearing the caches")
+                        deliver({"clear": True})
+                        last_id = await self._add_marker()
+                    cursor = collection.find(cursor_type=CursorType.TAILABLE_AWAIT)
+                    skipping = True
+                async for document in cursor:
+                    if skipping:
+                        skipping = document["_id"] != last_id
+                        continue
+                    last_id = document["_id"]
+                    if document["origin"] != self._origin and document["message"]:
+                        deliver(document["message"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(
+                    "Could not read the invalidations, clearing the caches"
+                )
+                deliver({"clear": True})
+                cursor = None
+                await asyncio.sleep(self._retry_delay)
+
+
+BUS: InvalidationBus = InMemoryBus()
@@ -12,6 +12,11 @@ def base_uri():
     return os.getenv("BASE_URI")
 
 
+@functools.lru_cache()
+def book_link_prefix():
+    return f"{base_uri()}book/"
+
+
 class Book(BaseModel):
     name: str
     author: str
@@ -47,14 +52,30 @@ class SingleBookResponse(BaseModel):
         )
 
 
+def single_book_response(book: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the same content as SingleBookResponse without a pydantic model."""
+    return {
+        "name": book["name"],
+        "author": book["author"],
+        "description": book["description"],
+        "genres": book["genres"],
+        "published_year": str(book["published_year"].year),
+        "link": f"{book_link_prefix()}{book['book_id']}",
+    }
+
+
 class SingleBookInAllBooksResponse(BaseModel):
     name: str
     author: str
     link: str
+    description: Optional[str] = None
+    genres: Optional[List[str]] = None
+    published_year: Optional[str] = None
 
 
 class AllBooksResponse(BaseModel):
     total_results: int
+    total_results_is_lower_bound: Optional[bool] = None
     prev_page: Optional[str] = None
     next_page: Optional[str] = None
     books: List[SingleBookInAllBooksResponse]
@@ -83,3 +104,69 @@ class AllBooksResponse(BaseModel):
             kwargs["prev_page"] = prev_page
 
         super().__init__(**kwargs)
+
+
+def all_books_response(
+    total_results: int,
+    books: List[Dict[str, Any]],
+    prev_page: Optional[str] = None,
+    next_page: Optional[str] = None,
+    fields: Optional[List[str]] = None,
+    total_results_is_lower_bound: bool = False,
+) -> Dict[str, Any]:
+    """Build the same content as AllBooksResponse without pydantic models.
+
+    The books hold the requested optional `fields` after the link.
+    """
+    content = {"total_results": total_results}
+    if total_results_is_lower_bound:
+        content["total_results_is_lower_bound"] = True
+    if prev_page is not None:
+        content["prev_page"] = prev_page
+    if next_page is not None:
+        content["next_page"] = next_page
+    link_prefix = book_link_prefix()
+    content["books"] = [
+        {
+            "name": book.get("name"),
+            "author": book.get("author"),
+            "link": f"{link_prefix}{book.get('book_id')}",
+        }
+        for book in books
+    ]
+    for field in fields or []:
+        for book, book_content in zip(books, content["books"]):
+            value = book.get(field)
+            if field == "published_year" and value is not None:
+                value = str(value.year)
+            book_content[field] = value
+    return content
+
+
+class BookIds(BaseModel):
+    ids: List[str]
+
+
+class BookInBatchResponse(BaseModel):
+    name: str
+    author: str
+    description: str
+    genres: List[str]
+    published_year: str
+    link: str
+    eTag: Optional[str] = None
+
+
+class BatchBooksResponse(BaseModel):
+    books: List[BookInBatchResponse]
+    missing: List[str]
+
+
+class BulkInsertError(BaseModel):
+    row: int
+    message: str
+
+
+class BulkInsertResponse(BaseModel):
+    inserted: int
+    errors: List[BulkInsertError]
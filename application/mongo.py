@@ -1,28 +1,274 @@
 """Module for handling the motor mongo package code."""
+import asyncio
 import contextlib
-import os
+import logging
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 import motor.motor_asyncio
-from pymongo.errors import DuplicateKeyError
+from pymongo import (
+    ASCENDING,
+    DESCENDING,
+    TEXT,
+    IndexModel,
+    ReturnDocument,
+    UpdateOne,
+)
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.read_preferences import (
+    Nearest,
+    Primary,
+    PrimaryPreferred,
+    Secondary,
+    SecondaryPreferred,
+    _ServerMode,
+)
+
+import application.cache as cache
+import application.invalidation as invalidation
+import application.settings as settings
 
 DB = "books"
 BOOKS_COLLECTION = "books"
 AUTHORS_COLLECTION = "authors"
 GENRES_COLLECTION = "genres"
+INVALIDATIONS_COLLECTION = "invalidations"
+CATALOG_COLLECTION = "catalog"
+CATALOG_VERSION_ID = "version"
+
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+# The key used for ordering and keyset pagination of books. It is unique in the
+# books collection so it can be used on its own as a cursor.
+BOOKS_SORT_KEY = "name"
+
+DUPLICATE_KEY_ERROR = 11000
+
+# The fields every page of books needs, other fields are only fetched on request
+LIST_FIELDS = [BOOKS_SORT_KEY, "author", "book_id"]
+OPTIONAL_LIST_FIELDS = ["description", "genres", "published_year"]
 
+# Fields searched by GET /books/search, a word found in the name weighs more
+TEXT_INDEX_WEIGHTS = {"name": 10, "description": 1}
+
+# The indexes every collection should have, applied by MongoBackend.ensure_indexes.
+# The compound indexes on the books collection match the filters of the list
+# endpoint and continue with the sort key so filtered pages need no in memory sort.
+# Except for the multikey genres index they also hold all the LIST_FIELDS, so
+# pages fetched with the default projection are covered by the index.
+INDEXES: Dict[str, List[IndexModel]] = {
+    BOOKS_COLLECTION: [
+        IndexModel([(BOOKS_SORT_KEY, ASCENDING)], unique=True),
+        IndexModel([("book_id", ASCENDING)], unique=True),
+        IndexModel([(field, ASCENDING) for field in LIST_FIELDS]),
+        IndexModel(
+            [("author", ASCENDING), (BOOKS_SORT_KEY, ASCENDING), ("book_id", ASCENDING)]
+        ),
+        IndexModel([("genres", ASCENDING), (BOOKS_SORT_KEY, ASCENDING)]),
+        IndexModel(
+            [(field, TEXT) for field in TEXT_INDEX_WEIGHTS], weights=TEXT_INDEX_WEIGHTS
+        ),
+        IndexModel(
+            [
+                ("published_year", ASCENDING),
+                (BOOKS_SORT_KEY, ASCENDING),
+                ("author", ASCENDING),
+                ("book_id", ASCENDING),
+            ]
+        ),
+    ],
+    AUTHORS_COLLECTION: [
+        IndexModel([("name", ASCENDING)], unique=True),
+        IndexModel([("book_count", DESCENDING), ("name", ASCENDING)]),
+    ],
+    GENRES_COLLECTION: [
+        IndexModel([("name", ASCENDING)], unique=True),
+        IndexModel([("book_count", DESCENDING), ("name", ASCENDING)]),
+    ],
+}
 
 BACKEND: Optional["MongoBackend"] = None
 
+logger = logging.getLogger(__name__)
+
 
 class BookExistsException(Exception):
     pass
 
 
+class PoolStats(ConnectionPoolListener):
+    """Keeps count of the connections of the pool of a client."""
+
+    def __init__(self) -> None:
+        self.open_connections = 0
+        self.checked_out_connections = 0
+
+    def connection_created(self, event) -> None:
+        self.open_connections += 1
+
+    def connection_closed(self, event) -> None:
+        self.open_connections -= 1
+
+    def connection_checked_out(self, event) -> None:
+        self.checked_out_connections += 1
+
+    def connection_checked_in(self, event) -> None:
+        self.checked_out_connections -= 1
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        pass
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def connection_check_out_started(self, event) -> None:
+        pass
+
+    def connection_check_out_failed(self, event) -> None:
+        pass
+
+
+def get_client_options() -> Dict[str, Any]:
+    write_concern = settings.MONGODB_WRITE_CONCERN
+    return {
+        "maxPoolSize": settings.MONGODB_MAX_POOL_SIZE,
+        "connectTimeoutMS": settings.MONGODB_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": settings.MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        # 0 waits on the socket for as long as it takes
+        "socketTimeoutMS": settings.MONGODB_SOCKET_TIMEOUT_MS or None,
+        "w": int(write_concern) if write_concern.isdigit() else write_concern,
+        "wTimeoutMS": settings.MONGODB_WRITE_TIMEOUT_MS,
+    }
+
+
+def get_list_read_preference() -> _ServerMode:
+    mode = READ_PREFERENCES[settings.MONGODB_LIST_READ_PREFERENCE]
+    if mode is Primary:
+        return Primary()
+    return mode(max_staleness=settings.MONGODB_MAX_STALENESS_SECONDS)
+
+
 class MongoBackend:
-    def __init__(self, uri: str) -> None:
-        self._client = motor.motor_asyncio.AsyncIOMotorClient(uri)
+    """Reads lists of books, authors and genres with the list read preference.
+
+    Those may go to secondaries. Single books are read from the primary, so a
+    book can be read as soon as it was written.
+    """
+
+    def __init__(self, uri: str, min_pool_size: int = 0) -> None:
+        self._pool_stats = PoolStats()
+        self._client = motor.motor_asyncio.AsyncIOMotorClient(
+            uri,
+            minPoolSize=min_pool_size,
+            event_listeners=[self._pool_stats],
+            **get_client_options(),
+        )
+        self._list_read_preference = get_list_read_preference()
+        self._list_database = self._client.get_database(
+            DB, read_preference=self._list_read_preference
+        )
+        self._last_write: Optional[Dict[str, Any]] = None
+
+    @property
+    def last_write(self) -> Optional[Dict[str, Any]]:
+        """Cluster and operation time of the last write known to this worker."""
+        return self._last_write
+
+    def advance_last_write(self, last_write: Optional[Dict[str, Any]]) -> None:
+        """Make list reads wait for a write, of this worker or of another one."""
+        if last_write is None:
+            return
+        if self._last_write is None:
+            self._last_write = last_write
+        elif last_write["operation_time"] > self._last_write["operation_time"]:
+            self._last_write = last_write
+
+    @contextlib.asynccontextmanager
+    async def _list_session(self) -> AsyncIterator[Any]:
+        """Causally consistent session, whose reads see the last write.
+
+        A secondary waits until it has replicated the last write before reading.
+        """
+        async with await self._client.start_session(causal_consistency=True) as session:
+            if self._last_write is not None:
+                session.advance_cluster_time(self._last_write["cluster_time"])
+                session.advance_operation_time(self._last_write["operation_time"])
+            yield session
+
+    async def ping(self, read_preference: Optional[_ServerMode] = None) -> None:
+        await self._client.admin.command("ping", read_preference=read_preference)
+
+    async def warm_up(self, connections: int) -> None:
+        """Open connections of the pools before the first requests need them.
+
+        Concurrent commands each check out a connection of their own, half of
+        them from the servers answering lists.
+        """
+        await asyncio.gather(
+            *(self.ping() for _ in range(connections - connections // 2)),
+            *(
+                self.ping(read_preference=self._list_read_preference)
+                for _ in range(connections // 2)
+            ),
+        )
+
+    def pool_stats(self) -> Dict[str, int]:
+        return {
+            "open_connections": self._pool_stats.open_connections,
+            "checked_out_connections": self._pool_stats.checked_out_connections,
+        }
+
+    def close(self) -> None:
+        self._client.close()
+
+    def create_invalidation_bus(self) -> invalidation.CappedCollectionBus:
+        return invalidation.CappedCollectionBus(
+            self._client[DB],
+            INVALIDATIONS_COLLECTION,
+            size=settings.INVALIDATION_COLLECTION_SIZE,
+        )
+
+    @staticmethod
+    def compare_indexes(
+        expected: List[IndexModel], existing: List[str]
+    ) -> Dict[str, List[str]]:
+        expected_names = [index.document["name"] for index in expected]
+        return {
+            "missing": [name for name in expected_names if name not in existing],
+            "extra": [
+                name
+                for name in existing
+                if name not in expected_names and name != "_id_"
+            ],
+        }
+
+    async def ensure_indexes(self) -> None:
+        """Create the indexes from INDEXES, existing ones are left untouched."""
+        for collection, indexes in INDEXES.items():
+            await self._client[DB][collection].create_indexes(indexes)
+
+    async def check_indexes(self) -> Dict[str, Dict[str, List[str]]]:
+        """Report the indexes missing from or not declared in INDEXES."""
+        report = {}
+        for collection, indexes in INDEXES.items():
+            existing = await self._client[DB][collection].index_information()
+            report[collection] = self.compare_indexes(indexes, list(existing))
+        return report
 
     @staticmethod
     def get_find_condition(
@@ -39,18 +285,31 @@ class MongoBackend:
             find_condition["published_year"] = published_year
         return find_condition
 
+    @cache.single_flight
     async def get_total_number_of_books(
         self,
         authors: Optional[List[str]] = None,
         genres: Optional[List[str]] = None,
         published_year: Optional[datetime] = None,
+        limit: Optional[int] = None,
     ) -> int:
-        return await self._client[DB][BOOKS_COLLECTION].count_documents(
-            self.get_find_condition(
-                authors=authors, genres=genres, published_year=published_year
+        """Count the books, counting no further than `limit` if it is given."""
+        options = {"limit": limit} if limit is not None else {}
+        async with self._list_session() as session:
+            return await self._list_database[BOOKS_COLLECTION].count_documents(
+                self.get_find_condition(
+                    authors=authors, genres=genres, published_year=published_year
+                ),
+                session=session,
+                **options,
             )
-        )
 
+    @cache.single_flight
+    async def get_estimated_number_of_books(self) -> int:
+        """Get the number of books from the collection metadata, without a filter."""
+        return await self._list_database[BOOKS_COLLECTION].estimated_document_count()
+
+    @cache.single_flight
     async def get_all_books(
         self,
         skips: int,
@@ -58,50 +317,391 @@ class MongoBackend:
         authors: Optional[List[str]] = None,
         genres: Optional[List[str]] = None,
         published_year: Optional[datetime] = None,
+        fields: Optional[List[str]] = None,
     ) -> List[Dict[str, Any]]:
-        cursor = (
-            self._client[DB][BOOKS_COLLECTION]
-            .find(
-                self.get_find_condition(
+        async with self._list_session() as session:
+            cursor = (
+                self._list_database[BOOKS_COLLECTION]
+                .find(
+                    self.get_find_condition(
+                        authors=authors, genres=genres, published_year=published_year
+                    ),
+                    self.get_list_projection(fields),
+                    session=session,
+                )
+                .sort(BOOKS_SORT_KEY, ASCENDING)
+                .skip(skips)
+                .limit(number_of_documents)
+            )
+            return [doc async for doc in cursor]
+
+    @staticmethod
+    def get_list_projection(fields: Optional[List[str]] = None) -> Dict[str, int]:
+        projection = {"_id": 0}
+        for field in LIST_FIELDS + (fields or []):
+            projection[field] = 1
+        return projection
+
+    @staticmethod
+    def get_key_condition(
+        after: Optional[str] = None, before: Optional[str] = None
+    ) -> Tuple[Dict[str, Any], int]:
+        if before is not None:
+            return {BOOKS_SORT_KEY: {"$lt": before}}, DESCENDING
+        if after is not None:
+            return {BOOKS_SORT_KEY: {"$gt": after}}, ASCENDING
+        return {}, ASCENDING
+
+    @cache.single_flight
+    async def get_books_by_key(
+        self,
+        number_of_documents: int,
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        authors: Optional[List[str]] = None,
+        genres: Optional[List[str]] = None,
+        published_year: Optional[datetime] = None,
+        fields: Optional[List[str]] = None,
+    ) -> List[Dict[str, Any]]:
+        """Get the books right after (or right before) a value of the sort key."""
+        key_condition, direction = self.get_key_condition(after=after, before=before)
+        async with self._list_session() as session:
+            cursor = (
+                self._list_database[BOOKS_COLLECTION]
+                .find(
+                    {
+                        **self.get_find_condition(
+                            authors=authors,
+                            genres=genres,
+                            published_year=published_year,
+                        ),
+                        **key_condition,
+                    },
+                    self.get_list_projection(fields),
+                    session=session,
+                )
+                .sort(BOOKS_SORT_KEY, direction)
+                .limit(number_of_documents)
+            )
+            books = [doc async for doc in cursor]
+        if direction == DESCENDING:
+            books.reverse()
+        return books
+
+    @cache.single_flight
+    async def get_books_with_total(
+        self,
+        number_of_documents: int,
+        skips: int = 0,
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        authors: Optional[List[str]] = None,
+        genres: Optional[List[str]] = None,
+        published_year: Optional[datetime] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Tuple[int, List[Dict[str, Any]]]:
+        """Count the matching books and get a page of them in a single query."""
+        key_condition, direction = self.get_key_condition(after=after, before=before)
+        page_stages = [
+            {"$match": key_condition},
+            {"$sort": {BOOKS_SORT_KEY: direction}},
+        ]
+        if skips:
+            page_stages.append({"$skip": skips})
+        page_stages += [
+            {"$limit": number_of_documents},
+            {"$project": self.get_list_projection(fields)},
+        ]
+        pipeline = [
+            {
+                "$match": self.get_find_condition(
                     authors=authors, genres=genres, published_year=published_year
-                ),
-                {"_id": 0},
+                )
+            },
+            {"$facet": {"total": [{"$count": "count"}], "books": page_stages}},
+        ]
+        async with self._list_session() as session:
+            result = await (
+                self._list_database[BOOKS_COLLECTION]
+                .aggregate(pipeline, session=session)
+                .to_list(length=1)
             )
-            .skip(skips)
-            .limit(number_of_documents)
-        )
-        return [doc async for doc in cursor]
+        total = result[0]["total"][0]["count"] if result[0]["total"] else 0
+        books = result[0]["books"]
+        if direction == DESCENDING:
+            books.reverse()
+        return total, books
+
+    @cache.single_flight
+    async def search_books(
+        self,
+        query: str,
+        skips: int,
+        number_of_documents: int,
+        fields: Optional[List[str]] = None,
+    ) -> Tuple[int, List[Dict[str, Any]]]:
+        """Count the books matching a text search and get a page of the best ones."""
+        page_stages = [{"$sort": {"score": DESCENDING, BOOKS_SORT_KEY: ASCENDING}}]
+        if skips:
+            page_stages.append({"$skip": skips})
+        page_stages += [
+            {"$limit": number_of_documents},
+            {"$project": self.get_list_projection(fields)},
+        ]
+        pipeline = [
+            {"$match": {"$text": {"$search": query}}},
+            {"$addFields": {"score": {"$meta": "textScore"}}},
+            {"$facet": {"total": [{"$count": "count"}], "books": page_stages}},
+        ]
+        async with self._list_session() as session:
+            result = await (
+                self._list_database[BOOKS_COLLECTION]
+                .aggregate(pipeline, session=session)
+                .to_list(length=1)
+            )
+        total = result[0]["total"][0]["count"] if result[0]["total"] else 0
+        return total, result[0]["books"]
+
+    async def iter_books(
+        self,
+        batch_size: int,
+        authors: Optional[List[str]] = None,
+        genres: Optional[List[str]] = None,
+        published_year: Optional[datetime] = None,
+        projection: Optional[List[str]] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Iterate over the matching books, `batch_size` books are fetched at a time.
+
+        Only the fields in `projection` are fetched when it is given.
+        """
+        async with self._list_session() as session:
+            cursor = (
+                self._list_database[BOOKS_COLLECTION]
+                .find(
+                    self.get_find_condition(
+                        authors=authors, genres=genres, published_year=published_year
+                    ),
+                    {"_id": 0, **{field: 1 for field in projection or []}},
+                    session=session,
+                )
+                .sort(BOOKS_SORT_KEY, ASCENDING)
+                .batch_size(batch_size)
+            )
+            async for doc in cursor:
+                yield doc
 
-    async def get_all_authors(self) -> List[Dict[str, Any]]:
-        cursor = self._client[DB][AUTHORS_COLLECTION].find({}, {"_id": 0})
-        return [doc async for doc in cursor]
+    async def _get_facet(
+        self,
+        collection: str,
+        limit: Optional[int] = None,
+        after: Optional[Dict[str, Any]] = None,
+        sort_by_count: bool = False,
+    ) -> List[Dict[str, Any]]:
+        condition = {}
+        if sort_by_count:
+            sort = [("book_count", DESCENDING), ("name", ASCENDING)]
+            if after is not None:
+                condition = {
+                    "$or": [
+                        {"book_count": {"$lt": after["book_count"]}},
+                        {
+                            "book_count": after["book_count"],
+                            "name": {"$gt": after["name"]},
+                        },
+                    ]
+                }
+        else:
+            sort = [("name", ASCENDING)]
+            if after is not None:
+                condition = {"name": {"$gt": after["name"]}}
+        async with self._list_session() as session:
+            cursor = (
+                self._list_database[collection]
+                .find(condition, {"_id": 0}, session=session)
+                .sort(sort)
+            )
+            if limit is not None:
+                cursor = cursor.limit(limit)
+            return [doc async for doc in cursor]
+
+    @cache.single_flight
+    async def get_all_authors(
+        self,
+        limit: Optional[int] = None,
+        after: Optional[Dict[str, Any]] = None,
+        sort_by_count: bool = False,
+    ) -> List[Dict[str, Any]]:
+        return await self._get_facet(
+            AUTHORS_COLLECTION, limit=limit, after=after, sort_by_count=sort_by_count
+        )
 
-    async def get_all_genres(self) -> List[Dict[str, Any]]:
-        cursor = self._client[DB][GENRES_COLLECTION].find({}, {"_id": 0})
-        return [doc async for doc in cursor]
+    @cache.single_flight
+    async def get_all_genres(
+        self,
+        limit: Optional[int] = None,
+        after: Optional[Dict[str, Any]] = None,
+        sort_by_count: bool = False,
+    ) -> List[Dict[str, Any]]:
+        return await self._get_facet(
+            GENRES_COLLECTION, limit=limit, after=after, sort_by_count=sort_by_count
+        )
 
+    @cache.single_flight
     async def get_single_book_by_id(self, book_id: str) -> Dict[str, Any]:
         return await self._client[DB][BOOKS_COLLECTION].find_one(
             {"book_id": book_id}, {"_id": 0}
         )
 
-    async def insert_authors_in_db(self, author: str) -> None:
-        with contextlib.suppress(DuplicateKeyError):
-            await self._client[DB][AUTHORS_COLLECTION].insert_one({"name": author})
+    @cache.single_flight
+    async def get_books_by_ids(self, book_ids: List[str]) -> List[Dict[str, Any]]:
+        """Get the books, looked up concurrently with `BATCH_IN_SIZE` ids at most."""
+
+        async def get_chunk(chunk: List[str]) -> List[Dict[str, Any]]:
+            cursor = self._client[DB][BOOKS_COLLECTION].find(
+                {"book_id": {"$in": chunk}}, {"_id": 0}
+            )
+            return [doc async for doc in cursor]
+
+        chunks = await asyncio.gather(
+            *[
+                get_chunk(book_ids[start : start + settings.BATCH_IN_SIZE])
+                for start in range(0, len(book_ids), settings.BATCH_IN_SIZE)
+            ]
+        )
+        return [book for chunk in chunks for book in chunk]
+
+    async def update_author_and_genre_counts(
+        self, authors: Dict[str, int], genres: Dict[str, int]
+    ) -> None:
+        """Add the changes to the book counts of the authors and genres.
+
+        Authors and genres are created with their first book and deleted when
+        their last book is gone. Each collection is written with one unordered
+        bulk write, both concurrently.
+        """
+
+        async def update_counts(collection: str, changes: Dict[str, int]) -> None:
+            try:
+                await self._client[DB][collection].bulk_write(
+                    [
+                        UpdateOne(
+                            {"name": name},
+                            {"$inc": {"book_count": change}},
+                            upsert=change > 0,
+                        )
+                        for name, change in changes.items()
+                    ],
+                    ordered=False,
+                )
+            except BulkWriteError as exc:
+                # A concurrent upsert of the same name may hit the unique index,
+                # retrying the increments which failed is then enough.
+                errors = exc.details["writeErrors"]
+                if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                    raise
+                names = list(changes)
+                await self._client[DB][collection].bulk_write(
+                    [
+                        UpdateOne(
+                            {"name": names[error["index"]]},
+                            {"$inc": {"book_count": changes[names[error["index"]]]}},
+                        )
+                        for error in errors
+                    ],
+                    ordered=False,
+                )
+            removed = [name for name, change in changes.items() if change < 0]
+            if removed:
+                await self._client[DB][collection].delete_many(
+                    {"name": {"$in": removed}, "book_count": {"$lte": 0}}
+                )
+
+        await asyncio.gather(
+            *[
+                update_counts(
+                    collection,
+                    {name: change for name, change in changes.items() if change},
+                )
+                for collection, changes in (
+                    (AUTHORS_COLLECTION, authors),
+                    (GENRES_COLLECTION, genres),
+                )
+                if any(changes.values())
+            ]
+        )
+
+    async def backfill_book_counts(self) -> None:
+        """Count the books of the authors and genres stored without a book count."""
+        for collection, field in (
+            (AUTHORS_COLLECTION, "author"),
+            (GENRES_COLLECTION, "genres"),
+        ):
+            uncounted = {"book_count": {"$exists": False}}
+            if await self._client[DB][collection].find_one(uncounted) is None:
+                continue
+            pipeline = [
+                *([{"$unwind": f"${field}"}] if field == "genres" else []),
+                {"$group": {"_id": f"${field}", "book_count": {"$sum": 1}}},
+                {"$project": {"_id": 0, "name": "$_id", "book_count": 1}},
+                {"$merge": {"into": collection, "on": "name"}},
+            ]
+            await self._client[DB][BOOKS_COLLECTION].aggregate(pipeline).to_list(None)
+            # Whatever is still not counted has no books
+            await self._client[DB][collection].delete_many(uncounted)
+
+    async def get_catalog_version(self) -> int:
+        document = await self._client[DB][CATALOG_COLLECTION].find_one(
+            {"_id": CATALOG_VERSION_ID}
+        )
+        return document["version"] if document is not None else 0
+
+    async def increment_catalog_version(self) -> int:
+        """Count one more write to the books, returning the new version.
 
-    async def insert_genres_in_db(self, genres: List[str]) -> None:
-        for genre in genres:
-            with contextlib.suppress(DuplicateKeyError):
-                await self._client[DB][GENRES_COLLECTION].insert_one({"name": genre})
+        It is the last write of every request writing books, so list reads made
+        after it also see the writes before it.
+        """
+        async with await self._client.start_session(causal_consistency=True) as session:
+            document = await self._client[DB][CATALOG_COLLECTION].find_one_and_update(
+                {"_id": CATALOG_VERSION_ID},
+                {"$inc": {"version": 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+                session=session,
+            )
+            # A standalone server has no cluster time, nor secondaries to wait for
+            if session.cluster_time is not None and session.operation_time is not None:
+                self.advance_last_write(
+                    {
+                        "cluster_time": session.cluster_time,
+                        "operation_time": session.operation_time,
+                    }
+                )
+        return document["version"]
 
     async def get_single_book_by_name(self, book_name: str) -> Dict[str, Any]:
         return await self._client[DB][BOOKS_COLLECTION].find_one(
             {"name": book_name}, {"_id": 0}
         )
 
-    async def update_one_book(self, book_id: str, data: Dict[str, Any]) -> None:
+    async def replace_one_book(
+        self, book_id: str, data: Dict[str, Any], e_tag: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Replace the book if its eTag is still `e_tag`, returning the old book.
+
+        Books stored without an eTag are replaced whatever `e_tag` is. None is
+        returned when nothing was replaced.
+        """
         data["book_id"] = book_id
-        await self._client[DB][BOOKS_COLLECTION].replace_one({"book_id": book_id}, data)
+        condition = {"book_id": book_id}
+        if e_tag is not None:
+            condition["eTag"] = {"$in": [e_tag, None]}
+        return await self._client[DB][BOOKS_COLLECTION].find_one_and_replace(
+            condition,
+            data,
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE,
+        )
 
     async def insert_one_book(self, data: Dict[str, Any]) -> None:
         try:
@@ -109,10 +709,61 @@ class MongoBackend:
         except DuplicateKeyError:
             raise BookExistsException()
 
-    async def delete_one_book(self, book_id: str) -> None:
-        await self._client[DB][BOOKS_COLLECTION].delete_one({"book_id": book_id})
+    async def insert_many_books(self, books: List[Dict[str, Any]]) -> List[int]:
+        """Insert the books unordered, returning the positions of existing books."""
+        try:
+            await self._client[DB][BOOKS_COLLECTION].insert_many(books, ordered=False)
+        except BulkWriteError as exc:
+            errors = exc.details["writeErrors"]
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            return [error["index"] for error in errors]
+        return []
+
+    async def delete_one_book(
+        self, book_id: str, e_tag: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Delete the book if its eTag is still `e_tag`, returning the deleted book.
+
+        Books stored without an eTag are deleted whatever `e_tag` is. None is
+        returned when nothing was deleted.
+        """
+        condition = {"book_id": book_id}
+        if e_tag is not None:
+            condition["eTag"] = {"$in": [e_tag, None]}
+        return await self._client[DB][BOOKS_COLLECTION].find_one_and_delete(
+            condition, projection={"_id": 0}
+        )
 
 
-def backend():
+async def backend():
     global BACKEND
-    BACKEND = MongoBackend(uri=os.getenv("MONGODB_URI"))
+    BACKEND = MongoBackend(
+        uri=settings.MONGODB_URI, min_pool_size=settings.WARMUP_CONNECTIONS
+    )
+    await BACKEND.ensure_indexes()
+    await BACKEND.backfill_book_counts()
+    for collection, report in (await BACKEND.check_indexes()).items():
+        if report["missing"] or report["extra"]:
+            logger.warning(
+                "Indexes of collection %s differ from the declared ones, "
+                "missing: %s, extra: %s",
+                collection,
+                report["missing"],
+                report["extra"],
+            )
+
+
+async def close_backend():
+    if BACKEND is not None:
+        BACKEND.close()
+
+
+async def start_invalidation_bus():
+    if settings.INVALIDATION_BUS == "mongo":
+        invalidation.BUS = BACKEND.create_invalidation_bus()
+    await invalidation.BUS.start()
+
+
+async def stop_invalidation_bus():
+    await invalidation.BUS.stop()
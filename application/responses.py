@@ -0,0 +1,16 @@
+"""Module for the response classes used by the routes."""
+from typing import Any
+
+import orjson
+from fastapi.responses import JSONResponse
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson.
+
+    Routes return it with content which already has the shape of their response
+    model, so FastAPI neither builds nor validates the response model.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
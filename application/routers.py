@@ -1,121 +1,878 @@
 """Module for containing the routes for the application."""
+import asyncio
+import base64
 import hashlib
 import json
+import logging
 import string
 import urllib
 import uuid
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
 
-from async_lru import alru_cache
-from fastapi import APIRouter, Header, Response, status
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Header,
+    Query,
+    Request,
+    Response,
+    status,
+)
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 
+import application.autocomplete as autocomplete
+import application.cache as cache
+import application.invalidation as invalidation
 import application.models as models
 import application.mongo as mongo
+import application.responses as responses
+import application.settings as settings
+import application.streaming as streaming
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
 
-@alru_cache()
-async def get_total_number_of_books(
-    authors: Optional[Tuple[str]] = None,
-    genres: Optional[Tuple[str]] = None,
-    published_year: Optional[datetime] = None,
-):
-    return await mongo.BACKEND.get_total_number_of_books(
-        authors=list(authors) if authors is not None else None,
-        genres=list(genres) if genres is not None else None,
-        published_year=published_year,
+SHARED_CACHE = cache.create_shared_cache(settings.SHARED_CACHE_URL)
+COUNT_CACHE = cache.TwoTierCache(
+    cache.CountCache(maxsize=settings.COUNT_CACHE_SIZE, ttl=settings.COUNT_CACHE_TTL),
+    SHARED_CACHE,
+    namespace="count",
+    ttl=settings.COUNT_CACHE_TTL,
+)
+BOOK_CACHE = cache.TwoTierCache(
+    cache.LRUCache(maxsize=settings.BOOK_CACHE_SIZE, ttl=settings.BOOK_CACHE_TTL),
+    SHARED_CACHE,
+    namespace="book",
+    ttl=settings.BOOK_CACHE_TTL,
+)
+COUNT_MODES = ("exact", "approximate", "capped")
+# Pages of books, including the ones fetched ahead of the request for them
+PAGE_CACHE = cache.TwoTierCache(
+    cache.LRUCache(maxsize=settings.PAGE_CACHE_SIZE, ttl=settings.PAGE_CACHE_TTL),
+    SHARED_CACHE,
+    namespace="page",
+    ttl=settings.PAGE_CACHE_TTL,
+)
+# Pages of authors and genres, their counts change with every write
+FACET_CACHE = cache.TwoTierCache(
+    cache.LRUCache(maxsize=settings.FACET_CACHE_SIZE, ttl=settings.FACET_CACHE_TTL),
+    SHARED_CACHE,
+    namespace="facet",
+    ttl=settings.FACET_CACHE_TTL,
+)
+AUTOCOMPLETE_INDEXES = {
+    "book": autocomplete.PrefixIndex(),
+    "author": autocomplete.PrefixIndex(),
+}
+# Rebuild of the autocomplete indexes after invalidations were lost
+AUTOCOMPLETE_REBUILD: Optional[asyncio.Future] = None
+# Books written while the autocomplete indexes are built, one list per build
+AUTOCOMPLETE_PENDING: List[List[Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]]] = []
+# Set once the connections and caches have been warmed up at startup
+WARMED_UP = False
+# Number of writes to the books, None until it is read from the database
+CATALOG_VERSION: Optional[int] = None
+
+
+async def warm_up() -> None:
+    """Open connections and fill the caches the first requests are going to use."""
+    global WARMED_UP
+    await mongo.BACKEND.warm_up(settings.WARMUP_CONNECTIONS)
+    await asyncio.gather(
+        get_catalog_version(),
+        get_facets(
+            "authors",
+            mongo.BACKEND.get_all_authors,
+            limit=None,
+            after=None,
+            sort_by_count=False,
+        ),
+        get_facets(
+            "genres",
+            mongo.BACKEND.get_all_genres,
+            limit=None,
+            after=None,
+            sort_by_count=False,
+        ),
+        warm_up_first_page_of_books(),
+    )
+    WARMED_UP = True
+
+
+async def warm_up_first_page_of_books() -> None:
+    count_key = cache.CountCache.key(authors=None, genres=None, published_year=None)
+    page_query = get_keyset_page_query(
+        settings.DEFAULT_PAGE_SIZE, after=None, before=None, fields=None
+    )
+    generation = cache.GENERATION
+    count_of_books, books = await mongo.BACKEND.get_books_with_total(**page_query)
+    await COUNT_CACHE.set(count_key, count_of_books, generation=generation)
+    await PAGE_CACHE.set(
+        cache.make_key((count_key, page_query)), books, generation=generation
     )
 
 
+async def build_autocomplete_indexes() -> None:
+    """Build new autocomplete indexes, then replace the ones in use.
+
+    The books written while the books are read are applied by book id, so a
+    book is in the new indexes once, whether the read saw it or not.
+    """
+    pending = []
+    AUTOCOMPLETE_PENDING.append(pending)
+    try:
+        books = {}
+        async for book in mongo.BACKEND.iter_books(
+            batch_size=settings.EXPORT_BATCH_SIZE,
+            projection=["book_id", "name", "author"],
+        ):
+            books[book["book_id"]] = book
+    finally:
+        AUTOCOMPLETE_PENDING.remove(pending)
+    for added, removed in pending:
+        for book in removed:
+            books.pop(book["book_id"], None)
+        for book in added:
+            books[book["book_id"]] = book
+    indexes = {"book": autocomplete.PrefixIndex(), "author": autocomplete.PrefixIndex()}
+    indexes["book"].add_many(book["name"] for book in books.values())
+    indexes["author"].add_many(book["author"] for book in books.values())
+    AUTOCOMPLETE_INDEXES.update(indexes)
+
+
+async def rebuild_autocomplete_indexes() -> None:
+    try:
+        await build_autocomplete_indexes()
+    except Exception:
+        # The indexes stay as they are until the next lost invalidations
+        logger.exception("Could not rebuild the autocomplete indexes")
+
+
+def schedule_autocomplete_rebuild() -> None:
+    global AUTOCOMPLETE_REBUILD
+    if AUTOCOMPLETE_REBUILD is not None:
+        # It may have read the books before the writes which were lost
+        AUTOCOMPLETE_REBUILD.cancel()
+    AUTOCOMPLETE_REBUILD = asyncio.ensure_future(rebuild_autocomplete_indexes())
+
+
+def update_autocomplete_indexes(
+    added: List[Dict[str, Any]] = (), removed: List[Dict[str, Any]] = ()
+) -> None:
+    for book in removed:
+        AUTOCOMPLETE_INDEXES["book"].remove(book["name"])
+        AUTOCOMPLETE_INDEXES["author"].remove(book["author"])
+    AUTOCOMPLETE_INDEXES["book"].add_many(book["name"] for book in added)
+    AUTOCOMPLETE_INDEXES["author"].add_many(book["author"] for book in added)
+
+
+def invalidation_message(
+    added: List[Dict[str, Any]] = (),
+    removed: List[Dict[str, Any]] = (),
+    clear: bool = False,
+) -> invalidation.Message:
+    fields = ["book_id", "name", "author", "genres", "published_year"]
+    return {
+        "added": [{field: book.get(field) for field in fields} for book in added],
+        "removed": [{field: book.get(field) for field in fields} for book in removed],
+        "clear": clear,
+    }
+
+
+def apply_invalidation(message: invalidation.Message) -> None:
+    """Bring the caches of this worker in line with a write of any worker."""
+    global CATALOG_VERSION
+    added, removed = message.get("added", []), message.get("removed", [])
+    # Reads still running must not cache what they got from before the write
+    cache.bump_generation()
+    SHARED_CACHE.forget_version()
+    # Lists read from secondaries after this must include the write
+    mongo.BACKEND.advance_last_write(message.get("last_write"))
+    if message.get("version") is None:
+        # Not incremented yet or writes were missed, read the version again
+        CATALOG_VERSION = None
+    elif CATALOG_VERSION is not None:
+        CATALOG_VERSION = max(CATALOG_VERSION, message["version"])
+    if message.get("clear"):
+        COUNT_CACHE.clear()
+        BOOK_CACHE.clear()
+    else:
+        COUNT_CACHE.local.invalidate(*added, *removed)
+        for book in [*added, *removed]:
+            BOOK_CACHE.pop(book["book_id"])
+    PAGE_CACHE.clear()
+    FACET_CACHE.clear()
+    if message.get("clear") and not added and not removed:
+        # Invalidations were lost, there is no telling which books changed
+        schedule_autocomplete_rebuild()
+    else:
+        update_autocomplete_indexes(added=added, removed=removed)
+        for pending in AUTOCOMPLETE_PENDING:
+            pending.append((added, removed))
+
+
+invalidation.subscribe(apply_invalidation)
+
+
+async def begin_catalog_write() -> None:
+    """Increment the catalog version before writing books.
+
+    Failing here fails the request before any book changed, so changed books
+    are never listed under the version from before them.
+    """
+    await mongo.BACKEND.increment_catalog_version()
+
+
+async def publish_invalidation(message: invalidation.Message) -> None:
+    global CATALOG_VERSION
+    # No worker must read the shared cache at the old version again, failing to
+    # bump it is only logged
+    await SHARED_CACHE.bump_version()
+    # Applied before anything which may fail, this worker must not serve what
+    # the write changed even when the write is answered with an error
+    invalidation.deliver({**message, "last_write": mongo.BACKEND.last_write})
+    # Incremented again, lists read during the write may hold the old books
+    # under the version incremented before it
+    try:
+        version = await mongo.BACKEND.increment_catalog_version()
+    except Exception:
+        # The other workers are told anyway, they read the version again
+        logger.exception("Could not increment the catalog version after a write")
+        version = None
+    if CATALOG_VERSION is not None and version is not None:
+        # Read by another request before the version was incremented
+        CATALOG_VERSION = max(CATALOG_VERSION, version)
+    await invalidation.BUS.publish(
+        {**message, "version": version, "last_write": mongo.BACKEND.last_write}
+    )
+
+
+async def get_catalog_version() -> int:
+    global CATALOG_VERSION
+    if CATALOG_VERSION is None:
+        CATALOG_VERSION = await mongo.BACKEND.get_catalog_version()
+    return CATALOG_VERSION
+
+
+def get_list_etag(request: Request, version: int) -> str:
+    """Weak ETag of a list, which changes with every write to the books."""
+    query = urllib.parse.urlencode(sorted(request.query_params.multi_items()))
+    digest = hashlib.sha1(f"{request.url.path}?{query}".encode()).hexdigest()
+    return f'W/"{version}-{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, which ignores the W/ prefix
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    opaque_tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+    return etag[2:] in opaque_tags
+
+
 def generate_hash_for_book(book: Dict[str, Any]) -> str:
     return hashlib.sha1(
         json.dumps(book, sort_keys=True, default=str).encode()
     ).hexdigest()
 
 
+def prepare_book_for_insert(book: models.Book) -> Dict[str, Any]:
+    book_to_insert = book.dict()
+    book_to_insert["book_id"] = str(uuid.uuid1())
+    book_to_insert["eTag"] = generate_hash_for_book(book_to_insert)
+    book_to_insert["author"] = string.capwords(book_to_insert["author"])
+    return book_to_insert
+
+
+def format_validation_error(exc: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(loc) for loc in error['loc'])}: {error['msg']}"
+        for error in exc.errors()
+    )
+
+
+def encode_facet_cursor(facet: Dict[str, Any]) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps(
+            {"name": facet["name"], "book_count": facet.get("book_count", 0)}
+        ).encode()
+    ).decode()
+
+
+def decode_facet_cursor(cursor: str) -> Dict[str, Any]:
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        name, book_count = decoded["name"], decoded["book_count"]
+    except (ValueError, TypeError, KeyError):
+        raise ValueError(f"Invalid cursor {cursor}")
+    if not isinstance(name, str) or not isinstance(book_count, int):
+        raise ValueError(f"Invalid cursor {cursor}")
+    return {"name": name, "book_count": book_count}
+
+
+def get_book_count_changes(
+    added: List[Dict[str, Any]] = (), removed: List[Dict[str, Any]] = ()
+) -> Tuple[Dict[str, int], Dict[str, int]]:
+    authors, genres = Counter(), Counter()
+    for book in added:
+        authors[book["author"]] += 1
+        genres.update(set(book["genres"]))
+    for book in removed:
+        authors[book["author"]] -= 1
+        genres.subtract(set(book["genres"]))
+    return dict(authors), dict(genres)
+
+
+async def get_facets(
+    path: str,
+    get_facet_from_db: Callable[..., Awaitable[List[Dict[str, Any]]]],
+    **query: Any,
+) -> List[Dict[str, Any]]:
+    key = cache.make_key((path, query))
+    facets = await FACET_CACHE.get(key)
+    if facets is None:
+        generation = cache.GENERATION
+        facets = await get_facet_from_db(**query)
+        await FACET_CACHE.set(key, facets, generation=generation)
+    return facets
+
+
+async def get_facet(
+    path: str,
+    get_facet_from_db: Callable[..., Awaitable[List[Dict[str, Any]]]],
+    request: Request,
+    response: Response,
+    if_none_match: Optional[str],
+    with_counts: bool,
+    limit: Optional[int],
+    cursor: Optional[str],
+    sort: str,
+) -> Union[List[Any], Dict[str, Any], Response]:
+    if sort not in ("name", "count"):
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message": "Only sorting by name or count is supported!!"}
+    after = None
+    if cursor is not None:
+        try:
+            after = decode_facet_cursor(cursor)
+        except ValueError:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {"message": "Invalid cursor!!"}
+
+    headers = {
+        "ETag": get_list_etag(request, await get_catalog_version()),
+        "Cache-Control": f"public, max-age={settings.FACET_MAX_AGE}, "
+        f"stale-while-revalidate={settings.FACET_STALE_WHILE_REVALIDATE}",
+    }
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+
+    # Fetch one extra facet to find out if there is anything beyond this page
+    facets = await get_facets(
+        path,
+        get_facet_from_db,
+        limit=limit + 1 if limit is not None else None,
+        after=after,
+        sort_by_count=sort == "count",
+    )
+    if limit is not None and len(facets) > limit:
+        facets = facets[:limit]
+        params = OrderedDict(limit=limit, cursor=encode_facet_cursor(facets[-1]))
+        if with_counts:
+            params["with_counts"] = "true"
+        if sort != "name":
+            params["sort"] = sort
+        next_page_url = f"{models.base_uri()}{path}?{urllib.parse.urlencode(params)}"
+        response.headers["Link"] = f'<{next_page_url}>; rel="next"'
+
+    if with_counts:
+        return [
+            {"name": facet["name"], "book_count": facet.get("book_count", 0)}
+            for facet in facets
+        ]
+    return [facet["name"] for facet in facets]
+
+
+@router.get("/health/live")
+async def get_liveness() -> Dict[str, str]:
+    return {"status": "ok"}
+
+
+@router.get("/health/ready")
+async def get_readiness(response: Response) -> Dict[str, Any]:
+    database_reachable = True
+    try:
+        await mongo.BACKEND.ping()
+    except Exception:
+        logger.exception("Could not reach the database")
+        database_reachable = False
+    ready = WARMED_UP and database_reachable
+    if not ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {
+        "status": "ok" if ready else "unavailable",
+        "warmed_up": WARMED_UP,
+        "database_reachable": database_reachable,
+        "pool": mongo.BACKEND.pool_stats(),
+        "caches": {
+            "counts": len(COUNT_CACHE),
+            "books": len(BOOK_CACHE),
+            "pages": len(PAGE_CACHE),
+            "facets": len(FACET_CACHE),
+            "autocomplete_books": len(AUTOCOMPLETE_INDEXES["book"]),
+            "autocomplete_authors": len(AUTOCOMPLETE_INDEXES["author"]),
+        },
+    }
+
+
 @router.get("/authors")
-async def get_all_authors() -> List[Dict[str, Any]]:
-    return [doc["name"] for doc in await mongo.BACKEND.get_all_authors()]
+async def get_all_authors(
+    request: Request,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    with_counts: bool = False,
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    sort: str = "name",
+) -> Union[List[Any], Dict[str, Any]]:
+    return await get_facet(
+        "authors",
+        mongo.BACKEND.get_all_authors,
+        request,
+        response,
+        if_none_match,
+        with_counts=with_counts,
+        limit=limit,
+        cursor=cursor,
+        sort=sort,
+    )
 
 
 @router.get("/genres")
-async def get_all_genres() -> List[Dict[str, Any]]:
-    return [doc["name"] for doc in await mongo.BACKEND.get_all_genres()]
+async def get_all_genres(
+    request: Request,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    with_counts: bool = False,
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    sort: str = "name",
+) -> Union[List[Any], Dict[str, Any]]:
+    return await get_facet(
+        "genres",
+        mongo.BACKEND.get_all_genres,
+        request,
+        response,
+        if_none_match,
+        with_counts=with_counts,
+        limit=limit,
+        cursor=cursor,
+        sort=sort,
+    )
+
+
+def encode_cursor(key: str, direction: str) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps({"key": key, "direction": direction}).encode()
+    ).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        key, direction = decoded["key"], decoded["direction"]
+    except (ValueError, TypeError, KeyError):
+        raise ValueError(f"Invalid cursor {cursor}")
+    if not isinstance(key, str) or direction not in ("next", "prev"):
+        raise ValueError(f"Invalid cursor {cursor}")
+    return key, direction
+
+
+def parse_filters(
+    authors: Optional[str] = None,
+    genres: Optional[str] = None,
+    published_year: Optional[str] = None,
+) -> Tuple[Optional[Tuple[str, ...]], Optional[Tuple[str, ...]], Optional[datetime]]:
+    return (
+        tuple(authors.strip('"').split(",")) if authors is not None else None,
+        tuple(genres.strip('"').split(",")) if genres is not None else None,
+        datetime.strptime(published_year, "%Y") if published_year is not None else None,
+    )
+
+
+def get_keyset_page_query(
+    number_of_documents: int,
+    after: Optional[str],
+    before: Optional[str],
+    fields: Optional[List[str]],
+) -> Dict[str, Any]:
+    # Fetch one extra book to find out if there is anything beyond this page
+    return {
+        "number_of_documents": number_of_documents + 1,
+        "after": after,
+        "before": before,
+        "fields": fields,
+    }
+
+
+async def get_page_of_books(
+    page_query: Dict[str, Any], filters: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    if "skips" in page_query:
+        return await mongo.BACKEND.get_all_books(**page_query, **filters)
+    return await mongo.BACKEND.get_books_by_key(**page_query, **filters)
+
+
+async def get_cheap_count_of_books(
+    count: str, filters: Dict[str, Any]
+) -> Tuple[int, bool]:
+    """Get a count of the books cheaper than counting all of them.
+
+    Returns the count and whether it is only a lower bound of the real count.
+    """
+    if count == "approximate" and not any(filters.values()):
+        return await mongo.BACKEND.get_estimated_number_of_books(), False
+    # A filtered count cannot be estimated, it is capped instead
+    count_of_books = await mongo.BACKEND.get_total_number_of_books(
+        **filters, limit=settings.COUNT_CAP
+    )
+    return count_of_books, count_of_books >= settings.COUNT_CAP
+
+
+async def prefetch_page_of_books(
+    count_key: cache.CountCacheKey,
+    page_query: Dict[str, Any],
+    filters: Dict[str, Any],
+) -> None:
+    page_key = cache.make_key((count_key, page_query))
+    if await PAGE_CACHE.get(page_key) is not None:
+        return
+    generation = cache.GENERATION
+    try:
+        await PAGE_CACHE.set(
+            page_key,
+            await get_page_of_books(page_query, filters),
+            generation=generation,
+        )
+    except Exception:
+        # The page is fetched again when it is requested
+        logger.exception("Could not prefetch a page of books")
+
+
+def get_books_page_url(
+    params: Dict[str, Any], path: str = "books", **page_params: Any
+) -> str:
+    query = urllib.parse.urlencode({**params, **page_params}, safe=",")
+    return f"{models.base_uri()}{path}?{query}"
 
 
 @router.get(
-    "/books", response_model=models.AllBooksResponse, response_model_exclude_unset=True
+    "/books",
+    response_model=Union[models.AllBooksResponse, models.SingleMessageResponse],
+    response_model_exclude_unset=True,
 )
 async def get_the_list_of_all_books(
+    request: Request,
+    response: Response,
+    background_tasks: BackgroundTasks,
     authors: Optional[str] = None,
     genres: Optional[str] = None,
     published_year: Optional[str] = None,
-    page: int = 1,
-) -> Dict[str, Any]:
+    page: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    page_size: Optional[int] = Query(None, ge=1, le=settings.MAX_PAGE_SIZE),
+    count: str = "exact",
+    if_none_match: Optional[str] = Header(None),
+) -> Union[Dict[str, Any], Response]:
     params = OrderedDict()
     next_page_url = None
     prev_page_url = None
-    number_of_documents = 3
+    number_of_documents = page_size or settings.DEFAULT_PAGE_SIZE
 
-    authors = tuple(authors.strip('"').split(",")) if authors is not None else None
-    genres = tuple(genres.strip('"').split(",")) if genres is not None else None
-    published_year = (
-        datetime.strptime(published_year, "%Y") if published_year is not None else None
-    )
+    if count not in COUNT_MODES:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "message": f"Only the count modes {','.join(COUNT_MODES)} are supported!!"
+        }
 
-    count_of_books = await get_total_number_of_books(
-        authors=authors, genres=genres, published_year=published_year
-    )
-    skips = number_of_documents * (page - 1)
-    all_books = [
-        book
-        for book in await mongo.BACKEND.get_all_books(
-            skips=skips,
-            number_of_documents=number_of_documents,
-            authors=list(authors) if authors is not None else None,
-            genres=list(genres) if genres is not None else None,
-            published_year=published_year if published_year is not None else None,
-        )
-    ]
+    authors, genres, published_year = parse_filters(authors, genres, published_year)
 
     if authors is not None:
-        params["authors"] = ".".join(authors)
+        params["authors"] = ",".join(authors)
     if genres is not None:
-        params["genres"] = ".".join(genres)
+        params["genres"] = ",".join(genres)
     if published_year is not None:
-        params["published_year"] = published_year
+        params["published_year"] = published_year.strftime("%Y")
+    if fields is not None:
+        fields = fields.strip('"').split(",")
+        if not set(fields).issubset(mongo.OPTIONAL_LIST_FIELDS):
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {
+                "message": "Only the fields "
+                f"{','.join(mongo.OPTIONAL_LIST_FIELDS)} can be requested!!"
+            }
+        params["fields"] = ",".join(fields)
+    if page_size is not None:
+        params["page_size"] = page_size
+    if count != "exact":
+        params["count"] = count
 
-    prev_page = None if page == 1 else page - 1
-    if prev_page is not None:
-        if not params:
-            prev_page_url = f"{models.base_uri()}books?page={prev_page}"
+    filters = {
+        "authors": list(authors) if authors is not None else None,
+        "genres": list(genres) if genres is not None else None,
+        "published_year": published_year,
+    }
+    count_key = cache.CountCache.key(
+        authors=authors, genres=genres, published_year=published_year
+    )
+
+    key, direction = None, "next"
+    offset_pagination = page is not None and cursor is None
+    if offset_pagination:
+        # Offset based pagination, kept for clients which still send `page`
+        skips = number_of_documents * (page - 1)
+        # Fetch one extra book, the count may not be exact
+        page_query = {
+            "skips": skips,
+            "number_of_documents": number_of_documents + 1,
+            "fields": fields,
+        }
+    else:
+        if cursor is not None:
+            try:
+                key, direction = decode_cursor(cursor)
+            except ValueError:
+                response.status_code = status.HTTP_400_BAD_REQUEST
+                return {"message": "Invalid cursor!!"}
+        page_query = get_keyset_page_query(
+            number_of_documents,
+            after=key if direction == "next" else None,
+            before=key if direction == "prev" else None,
+            fields=fields,
+        )
+
+    headers = {"ETag": get_list_etag(request, await get_catalog_version())}
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # Nothing read from here on is cached if a write is applied meanwhile
+    generation = cache.GENERATION
+    count_of_books = await COUNT_CACHE.get(count_key)
+    count_is_lower_bound = False
+    page_key = cache.make_key((count_key, page_query))
+    all_books = await PAGE_CACHE.get(page_key)
+    page_is_cached = all_books is not None
+    if count_of_books is not None:
+        if all_books is None:
+            all_books = await get_page_of_books(page_query, filters)
+    elif count == "exact":
+        if all_books is None:
+            count_of_books, all_books = await mongo.BACKEND.get_books_with_total(
+                **page_query, **filters
+            )
+        else:
+            count_of_books = await mongo.BACKEND.get_total_number_of_books(**filters)
+        await COUNT_CACHE.set(count_key, count_of_books, generation=generation)
+    else:
+        # Only exact counts are cached, cheaper ones are taken every time
+        if all_books is None:
+            (count_of_books, count_is_lower_bound), all_books = await asyncio.gather(
+                get_cheap_count_of_books(count, filters),
+                get_page_of_books(page_query, filters),
+            )
         else:
-            prev_page_url = (
-                f"{models.base_uri()}books?"
-                f"{urllib.parse.urlencode(params).replace('.', ',')}"
-                f"&page={prev_page}"
+            count_of_books, count_is_lower_bound = await get_cheap_count_of_books(
+                count, filters
             )
+    if not page_is_cached:
+        await PAGE_CACHE.set(page_key, all_books, generation=generation)
 
-    next_page = page + 1 if skips + number_of_documents < count_of_books else None
-    if next_page is not None:
-        if not params:
-            next_page_url = f"{models.base_uri()}books?page={next_page}"
+    more_books = len(all_books) > number_of_documents
+    if offset_pagination:
+        all_books = all_books[:number_of_documents]
+        next_page_query = {**page_query, "skips": skips + number_of_documents}
+        if page > 1:
+            prev_page_url = get_books_page_url(params, page=page - 1)
+        if more_books:
+            next_page_url = get_books_page_url(params, page=page + 1)
+        books_seen = skips + len(all_books) + more_books
+    else:
+        if direction == "next":
+            all_books = all_books[:number_of_documents]
+            has_prev_page, has_next_page = key is not None, more_books
         else:
-            next_page_url = (
-                f"{models.base_uri()}books?"
-                f"{urllib.parse.urlencode(params).replace('.', ',')}"
-                f"&page={next_page}"
+            all_books = all_books[-number_of_documents:]
+            has_prev_page, has_next_page = more_books, True
+
+        if all_books and has_prev_page:
+            prev_page_url = get_books_page_url(
+                params,
+                cursor=encode_cursor(all_books[0][mongo.BOOKS_SORT_KEY], "prev"),
+            )
+        if all_books and has_next_page:
+            next_page_url = get_books_page_url(
+                params,
+                cursor=encode_cursor(all_books[-1][mongo.BOOKS_SORT_KEY], "next"),
             )
+            next_page_query = {
+                **page_query,
+                "after": all_books[-1][mongo.BOOKS_SORT_KEY],
+                "before": None,
+            }
+        # Nothing is known about the books before a keyset page
+        books_seen = len(all_books) + more_books
 
-    return {
-        "total_results": count_of_books,
-        "prev_page": prev_page_url,
-        "next_page": next_page_url,
-        "books": all_books,
-    }
+    if count != "exact":
+        # Counts which are not exact must not contradict the page being served
+        count_of_books = max(count_of_books, books_seen)
+
+    if next_page_url is not None and settings.PREFETCH_NEXT_PAGE:
+        # Runs once the response has been sent
+        background_tasks.add_task(
+            prefetch_page_of_books, count_key, next_page_query, filters
+        )
+
+    return responses.FastJSONResponse(
+        models.all_books_response(
+            total_results=count_of_books,
+            books=all_books,
+            prev_page=prev_page_url,
+            next_page=next_page_url,
+            fields=fields,
+            total_results_is_lower_bound=count_is_lower_bound,
+        ),
+        headers=headers,
+    )
+
+
+@router.get(
+    "/books/search",
+    response_model=models.AllBooksResponse,
+    response_model_exclude_unset=True,
+)
+async def search_books(
+    q: str = Query(..., min_length=1),
+    page: int = Query(1, ge=1),
+    page_size: Optional[int] = Query(None, ge=1, le=settings.MAX_PAGE_SIZE),
+) -> Response:
+    number_of_documents = page_size or settings.DEFAULT_PAGE_SIZE
+    skips = number_of_documents * (page - 1)
+    count_of_books, all_books = await mongo.BACKEND.search_books(
+        query=q, skips=skips, number_of_documents=number_of_documents
+    )
+    params = {"q": q}
+    if page_size is not None:
+        params["page_size"] = page_size
+    prev_page_url = None
+    next_page_url = None
+    if page > 1:
+        prev_page_url = get_books_page_url(params, path="books/search", page=page - 1)
+    if skips + number_of_documents < count_of_books:
+        next_page_url = get_books_page_url(params, path="books/search", page=page + 1)
+    return responses.FastJSONResponse(
+        models.all_books_response(
+            total_results=count_of_books,
+            books=all_books,
+            prev_page=prev_page_url,
+            next_page=next_page_url,
+        )
+    )
+
+
+async def get_batch_of_books(
+    book_ids: List[str], response: Response, max_books: int
+) -> Union[Dict[str, Any], Response]:
+    book_ids = list(dict.fromkeys(book_ids))
+    if len(book_ids) > max_books:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message": f"At most {max_books} books can be fetched at once!!"}
+
+    books = dict(zip(book_ids, await BOOK_CACHE.get_many(book_ids)))
+    not_cached = [book_id for book_id, book in books.items() if book is None]
+    if not_cached:
+        generation = cache.GENERATION
+        for book in await mongo.BACKEND.get_books_by_ids(book_ids=not_cached):
+            await BOOK_CACHE.set(book["book_id"], book, generation=generation)
+            books[book["book_id"]] = book
+
+    return responses.FastJSONResponse(
+        {
+            "books": [
+                {**models.single_book_response(book), "eTag": book.get("eTag")}
+                for book in books.values()
+                if book is not None
+            ],
+            "missing": [book_id for book_id, book in books.items() if book is None],
+        }
+    )
+
+
+@router.get(
+    "/books/batch",
+    response_model=Union[models.BatchBooksResponse, models.SingleMessageResponse],
+)
+async def get_books_by_ids(
+    response: Response, ids: str = Query(..., min_length=1)
+) -> Union[Dict[str, Any], Response]:
+    return await get_batch_of_books(
+        ids.strip('"').split(","), response, settings.BATCH_MAX_BOOKS
+    )
+
+
+@router.post(
+    "/books/batch",
+    response_model=Union[models.BatchBooksResponse, models.SingleMessageResponse],
+)
+async def post_books_by_ids(
+    book_ids: models.BookIds, response: Response
+) -> Union[Dict[str, Any], Response]:
+    return await get_batch_of_books(
+        book_ids.ids, response, settings.BATCH_MAX_BOOKS_POST
+    )
+
+
+@router.get("/autocomplete")
+async def autocomplete_names(
+    response: Response,
+    prefix: str = Query(..., min_length=1),
+    kind: str = "book",
+    limit: int = Query(settings.AUTOCOMPLETE_LIMIT, ge=1, le=100),
+) -> Union[List[str], Dict[str, Any]]:
+    if kind not in AUTOCOMPLETE_INDEXES:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"message": "Only books and authors can be completed!!"}
+    return AUTOCOMPLETE_INDEXES[kind].complete(prefix, limit)
+
+
+def export_book(book: Dict[str, Any]) -> Dict[str, Any]:
+    return {**book, "published_year": book["published_year"].strftime("%Y")}
+
+
+@router.get("/books/export")
+async def export_all_books(
+    authors: Optional[str] = None,
+    genres: Optional[str] = None,
+    published_year: Optional[str] = None,
+) -> StreamingResponse:
+    authors, genres, published_year = parse_filters(authors, genres, published_year)
+    books = mongo.BACKEND.iter_books(
+        batch_size=settings.EXPORT_BATCH_SIZE,
+        authors=list(authors) if authors is not None else None,
+        genres=list(genres) if genres is not None else None,
+        published_year=published_year,
+    )
+    return StreamingResponse(
+        streaming.to_ndjson(export_book(book) async for book in books),
+        media_type="application/x-ndjson",
+    )
 
 
 @router.post(
@@ -123,23 +880,80 @@ async def get_the_list_of_all_books(
     response_model=Union[models.SingleBookResponse, models.SingleMessageResponse],
     status_code=201,
 )
-async def add_a_book(book: models.Book, response: Response) -> Dict[str, Any]:
-    book_to_insert = book.dict()
-    book_to_insert["book_id"] = str(uuid.uuid1())
-    book_to_insert["eTag"] = generate_hash_for_book(book_to_insert)
-    book_to_insert["author"] = string.capwords(book_to_insert["author"])
+async def add_a_book(
+    book: models.Book, response: Response
+) -> Union[Dict[str, Any], Response]:
+    book_to_insert = prepare_book_for_insert(book)
 
+    await begin_catalog_write()
     try:
         await mongo.BACKEND.insert_one_book(data=book_to_insert)
     except mongo.BookExistsException:
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"message": f"Book {book_to_insert.get('name')} already exists!!"}
 
-    await mongo.BACKEND.insert_authors_in_db(book_to_insert.get("author"))
-    await mongo.BACKEND.insert_genres_in_db(book_to_insert.get("genres"))
+    await mongo.BACKEND.update_author_and_genre_counts(
+        *get_book_count_changes(added=[book_to_insert])
+    )
+    await publish_invalidation(invalidation_message(added=[book_to_insert]))
+    # Not cached here, a concurrent write may already have changed it
+    book_in_db = await mongo.BACKEND.get_single_book_by_name(book_to_insert.get("name"))
+    return responses.FastJSONResponse(
+        models.single_book_response(book_in_db), status_code=status.HTTP_201_CREATED
+    )
+
+
+async def insert_batch_of_books(
+    batch: List[Tuple[int, Dict[str, Any]]]
+) -> List[Dict[str, Any]]:
+    await begin_catalog_write()
+    existing = set(await mongo.BACKEND.insert_many_books([book for _, book in batch]))
+    inserted_books = [
+        book for index, (_, book) in enumerate(batch) if index not in existing
+    ]
+    if inserted_books:
+        await mongo.BACKEND.update_author_and_genre_counts(
+            *get_book_count_changes(added=inserted_books)
+        )
+        # A bulk load touches most filters, evicting them one by one is not worth it
+        await publish_invalidation(
+            invalidation_message(added=inserted_books, clear=True)
+        )
+    return [
+        {"row": row, "message": f"Book {book['name']} already exists!!"}
+        for index, (row, book) in enumerate(batch)
+        if index in existing
+    ]
+
+
+@router.post("/books/bulk", response_model=models.BulkInsertResponse)
+async def add_books_in_bulk(request: Request) -> Dict[str, Any]:
+    inserted = 0
+    errors = []
+    batch = []
 
-    get_total_number_of_books.cache_clear()
-    return await mongo.BACKEND.get_single_book_by_name(book_to_insert.get("name"))
+    async def flush_batch():
+        nonlocal inserted
+        batch_errors = await insert_batch_of_books(batch)
+        inserted += len(batch) - len(batch_errors)
+        errors.extend(batch_errors)
+        batch.clear()
+
+    async for row, document in streaming.iter_documents(request.stream()):
+        if isinstance(document, streaming.InvalidDocument):
+            errors.append({"row": row, "message": document.message})
+            continue
+        try:
+            book = models.Book.parse_obj(document)
+        except ValidationError as exc:
+            errors.append({"row": row, "message": format_validation_error(exc)})
+            continue
+        batch.append((row, prepare_book_for_insert(book)))
+        if len(batch) >= settings.BULK_INSERT_BATCH_SIZE:
+            await flush_batch()
+    if batch:
+        await flush_batch()
+    return {"inserted": inserted, "errors": sorted(errors, key=lambda e: e["row"])}
 
 
 @router.get(
@@ -149,16 +963,21 @@ async def add_a_book(book: models.Book, response: Response) -> Dict[str, Any]:
 async def get_a_single_book(
     book_id: str, response: Response, if_none_match: Optional[str] = Header(None)
 ) -> Union[Dict[str, Any], Response]:
-    book = await mongo.BACKEND.get_single_book_by_id(book_id=book_id)
+    book = await BOOK_CACHE.get(book_id)
     if book is None:
-        response.status_code = status.HTTP_400_BAD_REQUEST
-        return {"message": "No such book exist!!"}
+        generation = cache.GENERATION
+        book = await mongo.BACKEND.get_single_book_by_id(book_id=book_id)
+        if book is None:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {"message": "No such book exist!!"}
+        await BOOK_CACHE.set(book_id, book, generation=generation)
     if if_none_match is not None:
         if book.get("eTag") == if_none_match:
             return Response(status_code=status.HTTP_304_NOT_MODIFIED)
-    if book.get("eTag") is not None:
-        response.headers["ETag"] = book.get("eTag")
-    return book
+    headers = {"ETag": book["eTag"]} if book.get("eTag") is not None else None
+    return responses.FastJSONResponse(
+        models.single_book_response(book), headers=headers
+    )
 
 
 @router.put(
@@ -171,40 +990,50 @@ async def update_a_book(
     response: Response,
     if_match: Optional[str] = Header(None),
 ) -> Union[Dict[str, Any], Response]:
-    book_in_db = await mongo.BACKEND.get_single_book_by_id(book_id=book_id)
-    if book_in_db is None:
-        response.status_code = status.HTTP_400_BAD_REQUEST
-        return {"message": "No such book exist!!"}
-
     book_details_to_insert = book.dict()
-
-    if if_match is not None and book_in_db.get("eTag") is not None:
-        if if_match != book_in_db.get("eTag"):
-            return Response(status_code=status.HTTP_412_PRECONDITION_FAILED)
-
     book_details_to_insert["eTag"] = generate_hash_for_book(book_details_to_insert)
+    book_details_to_insert["author"] = string.capwords(book_details_to_insert["author"])
 
-    await mongo.BACKEND.update_one_book(book_id=book_id, data=book_details_to_insert)
-    await mongo.BACKEND.insert_authors_in_db(
-        string.capwords(book_details_to_insert["author"])
+    await begin_catalog_write()
+    book_in_db = await mongo.BACKEND.replace_one_book(
+        book_id=book_id, data=book_details_to_insert, e_tag=if_match
     )
-    await mongo.BACKEND.insert_genres_in_db(book_details_to_insert["genres"])
+    if book_in_db is None:
+        # Nothing was replaced, find out if the book is missing or has changed
+        if await mongo.BACKEND.get_single_book_by_id(book_id=book_id) is None:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {"message": "No such book exist!!"}
+        return Response(status_code=status.HTTP_412_PRECONDITION_FAILED)
 
-    return await mongo.BACKEND.get_single_book_by_id(book_id=book_id)
+    await mongo.BACKEND.update_author_and_genre_counts(
+        *get_book_count_changes(added=[book_details_to_insert], removed=[book_in_db])
+    )
+    # The book is not cached here, a slower concurrent update finishing after a
+    # newer one would cache the older book. The next read caches it instead.
+    await publish_invalidation(
+        invalidation_message(added=[book_details_to_insert], removed=[book_in_db])
+    )
+
+    return responses.FastJSONResponse(
+        models.single_book_response(book_details_to_insert)
+    )
 
 
 @router.delete("/book/{book_id}", response_model=models.SingleMessageResponse)
 async def delete_a_book(
     book_id: str, response: Response, if_match: Optional[str] = Header(None)
 ) -> Union[Dict[str, Any], Response]:
-    book_in_db = await mongo.BACKEND.get_single_book_by_id(book_id=book_id)
+    await begin_catalog_write()
+    book_in_db = await mongo.BACKEND.delete_one_book(book_id=book_id, e_tag=if_match)
     if book_in_db is None:
-        response.status_code = status.HTTP_400_BAD_REQUEST
-        return {"message": "No such book exist!!"}
-
-    if if_match is not None and book_in_db.get("eTag") is not None:
-        if if_match != book_in_db.get("eTag"):
-            return Response(status_code=status.HTTP_412_PRECONDITION_FAILED)
+        # Nothing was deleted, find out if the book is missing or has changed
+        if await mongo.BACKEND.get_single_book_by_id(book_id=book_id) is None:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {"message": "No such book exist!!"}
+        return Response(status_code=status.HTTP_412_PRECONDITION_FAILED)
 
-    await mongo.BACKEND.delete_one_book(book_id=book_id)
+    await mongo.BACKEND.update_author_and_genre_counts(
+        *get_book_count_changes(removed=[book_in_db])
+    )
+    await publish_invalidation(invalidation_message(removed=[book_in_db]))
     return {"message": "Book deleted !!"}
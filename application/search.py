@@ -0,0 +1,49 @@
+"""Module for searching the text of books without a database."""
+import re
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Tuple
+
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from has in is it of on or that the to was with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [word for word in re.findall(r"\w+", text.lower()) if word not in STOP_WORDS]
+
+
+class TextIndex:
+    """Inverted index ranking documents like a Mongo text index does.
+
+    Words of the query are or-ed, a document scores the weight of the field for
+    every occurrence of a query word in that field.
+    """
+
+    def __init__(self, weights: Dict[str, float]) -> None:
+        self._weights = weights
+        self._postings: Dict[str, Dict[str, float]] = defaultdict(dict)
+        self._words_of_document: Dict[str, List[str]] = {}
+
+    def add(self, document_id: str, document: Dict[str, Any]) -> None:
+        self.remove(document_id)
+        scores = Counter()
+        for field, weight in self._weights.items():
+            for word in tokenize(document.get(field) or ""):
+                scores[word] += weight
+        for word, score in scores.items():
+            self._postings[word][document_id] = score
+        self._words_of_document[document_id] = list(scores)
+
+    def remove(self, document_id: str) -> None:
+        for word in self._words_of_document.pop(document_id, []):
+            del self._postings[word][document_id]
+            if not self._postings[word]:
+                del self._postings[word]
+
+    def search(self, query: str) -> List[Tuple[str, float]]:
+        """Get the ids and scores of the matching documents, best match first."""
+        scores = Counter()
+        for word in set(tokenize(query)):
+            for document_id, score in self._postings.get(word, {}).items():
+                scores[document_id] += score
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
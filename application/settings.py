@@ -0,0 +1,60 @@
+"""Module for the settings of the application read from the environment."""
+import os
+import pathlib
+
+from dotenv import load_dotenv
+
+# load the environment from the file app.env in the project directory
+basedir = pathlib.Path(__file__).parent.parent
+load_dotenv(basedir / "app.env")
+
+MONGODB_URI = os.getenv("MONGODB_URI")
+
+COUNT_CACHE_SIZE = int(os.getenv("COUNT_CACHE_SIZE", "1024"))
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL", "60"))
+
+BOOK_CACHE_SIZE = int(os.getenv("BOOK_CACHE_SIZE", "1024"))
+BOOK_CACHE_TTL = float(os.getenv("BOOK_CACHE_TTL", "300"))
+
+BULK_INSERT_BATCH_SIZE = int(os.getenv("BULK_INSERT_BATCH_SIZE", "1000"))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+AUTOCOMPLETE_LIMIT = int(os.getenv("AUTOCOMPLETE_LIMIT", "10"))
+
+BATCH_MAX_BOOKS = int(os.getenv("BATCH_MAX_BOOKS", "100"))
+# POST takes the ids in the body, which holds longer lists than a URL
+BATCH_MAX_BOOKS_POST = int(os.getenv("BATCH_MAX_BOOKS_POST", "1000"))
+# Ids looked up with a single $in
+BATCH_IN_SIZE = int(os.getenv("BATCH_IN_SIZE", "200"))
+
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "3"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "100"))
+PREFETCH_NEXT_PAGE = os.getenv("PREFETCH_NEXT_PAGE", "true").lower() == "true"
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", "256"))
+PAGE_CACHE_TTL = float(os.getenv("PAGE_CACHE_TTL", "10"))
+COUNT_CAP = int(os.getenv("COUNT_CAP", "1000"))
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "10"))
+FACET_CACHE_SIZE = int(os.getenv("FACET_CACHE_SIZE", "128"))
+FACET_CACHE_TTL = float(os.getenv("FACET_CACHE_TTL", "60"))
+# "memory" for a single worker, "mongo" to share invalidations between workers
+INVALIDATION_BUS = os.getenv("INVALIDATION_BUS", "memory")
+INVALIDATION_COLLECTION_SIZE = int(os.getenv("INVALIDATION_COLLECTION_SIZE", "1048576"))
+# Redis URL of the cache shared by the workers, empty to share nothing
+SHARED_CACHE_URL = os.getenv("SHARED_CACHE_URL", "")
+FACET_MAX_AGE = int(os.getenv("FACET_MAX_AGE", "10"))
+FACET_STALE_WHILE_REVALIDATE = int(os.getenv("FACET_STALE_WHILE_REVALIDATE", "60"))
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "100"))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "10000"))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(
+    os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "30000")
+)
+MONGODB_SOCKET_TIMEOUT_MS = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "0"))
+# A number of servers or "majority"
+MONGODB_WRITE_CONCERN = os.getenv("MONGODB_WRITE_CONCERN", "majority")
+MONGODB_WRITE_TIMEOUT_MS = int(os.getenv("MONGODB_WRITE_TIMEOUT_MS", "10000"))
+# Read preference of the lists of books, authors and genres
+MONGODB_LIST_READ_PREFERENCE = os.getenv(
+    "MONGODB_LIST_READ_PREFERENCE", "secondaryPreferred"
+)
+# -1 for no bound, otherwise at least 90 seconds
+MONGODB_MAX_STALENESS_SECONDS = int(os.getenv("MONGODB_MAX_STALENESS_SECONDS", "90"))
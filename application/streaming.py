@@ -0,0 +1,134 @@
+"""Module for reading and writing streams of JSON documents."""
+import codecs
+import json
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+
+class InvalidDocument:
+    """Stands in for a document of a stream which could not be parsed."""
+
+    def __init__(self, message: str) -> None:
+        self.message = message
+
+
+class DocumentParser:
+    """Incremental parser for NDJSON or for a single JSON array of documents.
+
+    Text is fed in as it arrives and only the document being parsed is kept in
+    memory. Parsing stops at the first document larger than `max_document_size`
+    characters, and in a JSON array at the first syntax error.
+    """
+
+    def __init__(self, max_document_size: int = 1024 * 1024) -> None:
+        self.done = False
+        self._max_document_size = max_document_size
+        self._buffer = ""
+        self._is_array: Optional[bool] = None
+        self._expecting_separator = False
+
+    def feed(self, text: str) -> List[Any]:
+        self._buffer += text
+        return self._parse(final=False)
+
+    def close(self) -> List[Any]:
+        return self._parse(final=True)
+
+    def _parse(self, final: bool) -> List[Any]:
+        if self.done:
+            return []
+        if self._is_array is None:
+            self._buffer = self._buffer.lstrip()
+            if not self._buffer:
+                return []
+            self._is_array = self._buffer.startswith("[")
+            if self._is_array:
+                self._buffer = self._buffer[1:]
+        documents = (
+            self._parse_array(final) if self._is_array else self._parse_lines(final)
+        )
+        if not self.done and len(self._buffer) > self._max_document_size:
+            documents.append(
+                InvalidDocument(
+                    f"Document is larger than {self._max_document_size} characters"
+                )
+            )
+            self._stop()
+        return documents
+
+    def _stop(self) -> None:
+        self.done = True
+        self._buffer = ""
+
+    def _parse_lines(self, final: bool) -> List[Any]:
+        lines = self._buffer.split("\n")
+        self._buffer = "" if final else lines.pop()
+        documents = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                documents.append(json.loads(line))
+            except ValueError as exc:
+                documents.append(InvalidDocument(f"Invalid JSON: {exc}"))
+        if final:
+            self.done = True
+        return documents
+
+    def _parse_array(self, final: bool) -> List[Any]:
+        decoder = json.JSONDecoder()
+        documents = []
+        while not self.done:
+            self._buffer = self._buffer.lstrip()
+            if not self._buffer:
+                break
+            if self._buffer.startswith("]"):
+                self._stop()
+                break
+            if self._expecting_separator:
+                if not self._buffer.startswith(","):
+                    documents.append(InvalidDocument("Expected ',' or ']'"))
+                    self._stop()
+                    break
+                self._buffer = self._buffer[1:]
+                self._expecting_separator = False
+                continue
+            try:
+                document, end = decoder.raw_decode(self._buffer)
+            except ValueError as exc:
+                if final:
+                    documents.append(InvalidDocument(f"Invalid JSON: {exc}"))
+                    self._stop()
+                break
+            if end == len(self._buffer) and not final:
+                # The document may continue in the next chunk, e.g. a number
+                break
+            documents.append(document)
+            self._buffer = self._buffer[end:]
+            self._expecting_separator = True
+        if final and not self.done:
+            documents.append(InvalidDocument("Unterminated JSON array"))
+            self._stop()
+        return documents
+
+
+async def iter_documents(
+    chunks: AsyncIterator[bytes], max_document_size: int = 1024 * 1024
+) -> AsyncIterator[Tuple[int, Any]]:
+    """Yield the row number and the document for every document of the stream."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    parser = DocumentParser(max_document_size=max_document_size)
+    row = 0
+    async for chunk in chunks:
+        for document in parser.feed(decoder.decode(chunk)):
+            row += 1
+            yield row, document
+        if parser.done:
+            return
+    for document in parser.feed(decoder.decode(b"", final=True)) + parser.close():
+        row += 1
+        yield row, document
+
+
+async def to_ndjson(documents: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    async for document in documents:
+        yield json.dumps(document, default=str).encode() + b"\n"
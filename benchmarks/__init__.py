@@ -0,0 +1 @@
+"""Benchmarks of the routes of the application."""
@@ -0,0 +1,511 @@
+"""Latency and throughput benchmark of the routes.
+
+The app is driven in process through ASGI, or over a socket when uvicorn serves
+it, against the in memory backend of the tests with a configurable latency or
+against a mongod. Run it from the root of the repository:
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --baseline results.json --tolerance 0.2
+
+The run fails when a route is slower than in the baseline by more than the
+tolerance.
+"""
+import argparse
+import asyncio
+import json
+import math
+import platform
+import random
+import sys
+import time
+import urllib.parse
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from application import app, mongo, routers, settings
+from tests.memory_backend import MockedBackend
+
+HttpResponse = Tuple[int, Dict[str, str], bytes]
+# A request is made of the method, the path with its query, the headers and the body
+HttpRequest = Tuple[str, str, Dict[str, str], bytes]
+
+AUTHORS = [f"Author Number {number}" for number in range(50)]
+GENRES = [f"Genre {number}" for number in range(10)]
+
+
+class ASGITransport:
+    """Calls the ASGI app directly, without any socket.
+
+    A request is complete once the last part of the body has been sent, the
+    background tasks of the response then go on without holding the caller.
+    """
+
+    def __init__(self, asgi_app: Callable) -> None:
+        self._app = asgi_app
+        self._tasks: List[asyncio.Future] = []
+
+    async def request(
+        self, method: str, path: str, headers: Dict[str, str], body: bytes = b""
+    ) -> HttpResponse:
+        path, _, query = path.partition("?")
+        raw_headers = [(b"host", b"benchmark")]
+        raw_headers += [
+            (name.lower().encode(), value.encode()) for name, value in headers.items()
+        ]
+        if body:
+            raw_headers.append((b"content-length", str(len(body)).encode()))
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": urllib.parse.unquote(path),
+            "raw_path": path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": raw_headers,
+            "client": ("127.0.0.1", 0),
+            "server": ("benchmark", 80),
+        }
+        request_messages = [{"type": "http.request", "body": body, "more_body": False}]
+        done = asyncio.Event()
+        response = {"status": 0, "headers": {}, "body": []}
+
+        async def receive() -> Dict[str, Any]:
+            if request_messages:
+                return request_messages.pop()
+            # Only disconnect once the whole response has been sent
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = {
+                    name.decode().lower(): value.decode()
+                    for name, value in message.get("headers", [])
+                }
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    done.set()
+
+        task = asyncio.ensure_future(self._app(scope, receive, send))
+        self._tasks.append(task)
+        answered = asyncio.ensure_future(done.wait())
+        await asyncio.wait([task, answered], return_when=asyncio.FIRST_COMPLETED)
+        if not done.is_set():
+            # The app failed before answering
+            answered.cancel()
+            await task
+        return response["status"], response["headers"], b"".join(response["body"])
+
+    async def close(self) -> None:
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class SocketTransport:
+    """Sends requests over keep alive HTTP/1.1 connections.
+
+    Responses must have a Content-Length, which all the benchmarked routes have.
+    """
+
+    def __init__(self, host: str, port: int) -> None:
+        self._host = host
+        self._port = port
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+
+    async def request(
+        self, method: str, path: str, headers: Dict[str, str], body: bytes = b""
+    ) -> HttpResponse:
+        if self._idle:
+            reader, writer = self._idle.pop()
+        else:
+            reader, writer = await asyncio.open_connection(self._host, self._port)
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self._host}:{self._port}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        lines.append(f"Content-Length: {len(body)}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+
+        status = int((await reader.readline()).split()[1])
+        response_headers = {}
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            response_headers[name.lower()] = value.strip()
+        length = int(response_headers.get("content-length", "0"))
+        response_body = await reader.readexactly(length) if length else b""
+        self._idle.append((reader, writer))
+        return status, response_headers, response_body
+
+    async def close(self) -> None:
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    """Nearest rank percentile of values sorted in ascending order."""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict[str, Any]:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(1000 * sum(latencies) / len(latencies), 3)
+        if latencies
+        else 0.0,
+        "p50_ms": round(1000 * percentile(latencies, 50), 3),
+        "p95_ms": round(1000 * percentile(latencies, 95), 3),
+        "p99_ms": round(1000 * percentile(latencies, 99), 3),
+    }
+
+
+async def measure(
+    transport: Any,
+    make_request: Callable[[int], HttpRequest],
+    expected_status: int,
+    requests: int,
+    concurrency: int,
+) -> Dict[str, Any]:
+    """Send `requests` requests, at most `concurrency` of them at a time."""
+    latencies: List[float] = []
+    errors = 0
+    next_request = iter(range(requests))
+
+    async def worker() -> None:
+        nonlocal errors
+        for number in next_request:
+            method, path, headers, body = make_request(number)
+            started = time.perf_counter()
+            try:
+                status, _, _ = await transport.request(method, path, headers, body)
+            except Exception:
+                status = None
+            latencies.append(time.perf_counter() - started)
+            if status != expected_status:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, requests))))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def make_book(name: str, rng: random.Random) -> Dict[str, Any]:
+    return {
+        "name": name,
+        "author": rng.choice(AUTHORS),
+        "genres": rng.sample(GENRES, 2),
+        "published_year": str(rng.randint(1950, 2020)),
+        "description": "A book written for the benchmarks",
+    }
+
+
+async def seed_books(transport: Any, number_of_books: int, rng: random.Random) -> None:
+    body = "\n".join(
+        json.dumps(make_book(f"Benchmark book {number:06d}", rng))
+        for number in range(number_of_books)
+    ).encode()
+    status, _, response = await transport.request(
+        "POST", "/books/bulk", {"Content-Type": "application/x-ndjson"}, body
+    )
+    if status != 200:
+        raise RuntimeError(f"Could not seed the books: {status} {response!r}")
+
+
+async def get_book_ids(transport: Any) -> List[str]:
+    book_ids = []
+    path: Optional[str] = f"/books?page_size={settings.MAX_PAGE_SIZE}"
+    while path is not None:
+        _, _, response = await transport.request("GET", path, {})
+        page = json.loads(response)
+        book_ids += [book["link"].rsplit("/", 1)[1] for book in page["books"]]
+        next_page = page.get("next_page")
+        path = None
+        if next_page is not None:
+            url = urllib.parse.urlsplit(next_page)
+            path = f"{url.path}?{url.query}"
+    return book_ids
+
+
+async def get_etags(transport: Any, book_ids: List[str]) -> Dict[str, str]:
+    etags = {}
+    for book_id in book_ids:
+        _, headers, _ = await transport.request("GET", f"/book/{book_id}", {})
+        etags[book_id] = headers["etag"]
+    return etags
+
+
+async def run_scenarios(
+    transport: Any, args: argparse.Namespace
+) -> Dict[str, Dict[str, Any]]:
+    rng = random.Random(args.seed)
+    await seed_books(transport, args.books, rng)
+    book_ids = await get_book_ids(transport)
+    sampled_ids = rng.sample(book_ids, min(len(book_ids), 100))
+    etags = await get_etags(transport, sampled_ids)
+    created_ids: List[str] = []
+
+    def filtered_books(number: int) -> HttpRequest:
+        authors = ",".join(rng.sample(AUTHORS, 2))
+        query = urllib.parse.urlencode(
+            {"authors": authors, "genres": rng.choice(GENRES)}
+        )
+        return "GET", f"/books?{query}", {}, b""
+
+    def new_book(number: int) -> HttpRequest:
+        book = make_book(f"Benchmark new book {uuid.uuid4()}", rng)
+        return (
+            "POST",
+            "/books",
+            {"Content-Type": "application/json"},
+            json.dumps(book).encode(),
+        )
+
+    def updated_book(number: int) -> HttpRequest:
+        book = make_book(f"Benchmark updated book {uuid.uuid4()}", rng)
+        return (
+            "PUT",
+            f"/book/{created_ids[number % len(created_ids)]}",
+            {"Content-Type": "application/json"},
+            json.dumps(book).encode(),
+        )
+
+    # Reads come first, writes clear the caches the reads rely on
+    scenarios = [
+        ("GET /books", lambda number: ("GET", "/books", {}, b""), 200),
+        ("GET /books with filters", filtered_books, 200),
+        (
+            "GET /books with page",
+            lambda number: ("GET", f"/books?page={rng.randint(1, 10)}", {}, b""),
+            200,
+        ),
+        (
+            "GET /book/{book_id}",
+            lambda number: ("GET", f"/book/{rng.choice(sampled_ids)}", {}, b""),
+            200,
+        ),
+        (
+            "GET /book/{book_id} with If-None-Match",
+            lambda number: (
+                "GET",
+                f"/book/{sampled_ids[number % len(sampled_ids)]}",
+                {"If-None-Match": etags[sampled_ids[number % len(sampled_ids)]]},
+                b"",
+            ),
+            304,
+        ),
+        ("POST /books", new_book, 201),
+        ("PUT /book/{book_id}", updated_book, 200),
+        (
+            "DELETE /book/{book_id}",
+            lambda number: ("DELETE", f"/book/{created_ids[number]}", {}, b""),
+            200,
+        ),
+    ]
+    results = {}
+    for name, make_request, expected_status in scenarios:
+        if args.route and not any(route in name for route in args.route):
+            continue
+        requests = args.requests
+        if name.startswith(("PUT", "DELETE")):
+            if not created_ids:
+                # The books created by POST, or the seeded ones without POST
+                seeded_ids = set(book_ids)
+                all_ids = await get_book_ids(transport)
+                created_ids += [
+                    book_id for book_id in all_ids if book_id not in seeded_ids
+                ] or all_ids
+            if name.startswith("DELETE"):
+                requests = min(requests, len(created_ids))
+        if name.startswith("GET") and args.warmup:
+            # Not measured, fills the caches and the connection pools first
+            await measure(
+                transport, make_request, expected_status, args.warmup, args.concurrency
+            )
+        results[name] = await measure(
+            transport, make_request, expected_status, requests, args.concurrency
+        )
+    return results
+
+
+async def serve(lifespan: str) -> Tuple[Any, asyncio.Future, int]:
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("uvicorn is needed to benchmark over a socket")
+    config = uvicorn.Config(
+        app, host="127.0.0.1", port=0, lifespan=lifespan, log_level="warning"
+    )
+    server = uvicorn.Server(config)
+    task = asyncio.ensure_future(server.serve())
+    while not server.started:
+        if task.done():
+            await task
+            raise SystemExit("uvicorn could not start")
+        await asyncio.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, task, port
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    if args.backend == "mongo":
+        import motor.motor_asyncio
+
+        # Never touch the database of the service
+        settings.MONGODB_URI = args.mongodb_uri
+        mongo.DB = args.database
+        client = motor.motor_asyncio.AsyncIOMotorClient(args.mongodb_uri)
+        await client.drop_database(args.database)
+    else:
+        mongo.BACKEND = MockedBackend(books=[], latency=args.latency)
+
+    server = None
+    if args.transport == "socket":
+        # The lifespan of the app connects to mongo, the memory backend is set up
+        server, server_task, port = await serve(
+            "on" if args.backend == "mongo" else "off"
+        )
+        transport = SocketTransport("127.0.0.1", port)
+    else:
+        if args.backend == "mongo":
+            await app.router.startup()
+        transport = ASGITransport(app)
+    if args.backend == "memory":
+        await routers.warm_up()
+
+    try:
+        routes = await run_scenarios(transport, args)
+    finally:
+        await transport.close()
+        if server is not None:
+            server.should_exit = True
+            await server_task
+        elif args.backend == "mongo":
+            await app.router.shutdown()
+        if args.backend == "mongo":
+            await client.drop_database(args.database)
+            client.close()
+
+    return {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "backend": args.backend,
+            "transport": args.transport,
+            "latency": args.latency if args.backend == "memory" else None,
+            "books": args.books,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "warmup": args.warmup,
+        },
+        "routes": routes,
+    }
+
+
+def find_regressions(
+    results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """Describe every route which got slower than in the baseline."""
+    regressions = []
+    for route, stats in results["routes"].items():
+        base = baseline["routes"].get(route)
+        if base is None:
+            continue
+        for percentile_name in ("p95_ms", "p99_ms"):
+            if stats[percentile_name] > base[percentile_name] * (1 + tolerance):
+                regressions.append(
+                    f"{route}: {percentile_name} {stats[percentile_name]} "
+                    f"> {base[percentile_name]}"
+                )
+        if stats["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{route}: throughput {stats['throughput']} < {base['throughput']}"
+            )
+        if stats["errors"] > base["errors"]:
+            regressions.append(f"{route}: errors {stats['errors']} > {base['errors']}")
+    return regressions
+
+
+def print_results(results: Dict[str, Any]) -> None:
+    print(
+        f"{'route':42} {'requests':>8} {'errors':>6} {'req/s':>9} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    for route, stats in results["routes"].items():
+        print(
+            f"{route:42} {stats['requests']:>8} {stats['errors']:>6} "
+            f"{stats['throughput']:>9.1f} {stats['p50_ms']:>8.2f} "
+            f"{stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f}"
+        )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=["memory", "mongo"], default="memory")
+    parser.add_argument("--transport", choices=["asgi", "socket"], default="asgi")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.001,
+        help="Seconds every call to the memory backend takes",
+    )
+    parser.add_argument("--mongodb-uri", default="mongodb://localhost:27017")
+    parser.add_argument(
+        "--database",
+        default="books_benchmark",
+        help="Database of the mongo backend, it is dropped before and after the run",
+    )
+    parser.add_argument("--books", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=200, help="Per route")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--warmup", type=int, default=20, help="Unmeasured requests per read route"
+    )
+    parser.add_argument(
+        "--route", action="append", help="Only run the routes containing this text"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="File to save the results to as JSON")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare to")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction a route may be slower than in the baseline",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(
+                results, json.load(baseline_file), args.tolerance
+            )
+        for regression in regressions:
+            print(f"Regression of {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,7 +20,7 @@ def flake8(session):
 @nox.session
 def tests_unit(session):
     session.install("poetry")
-    session.run("poetry", "install")
+    session.run("poetry", "install", "--extras", "redis")
     os.chdir("tests")
     session.run("python", "-m", "pytest", "-s", "-v", "unit")
 
@@ -28,9 +28,18 @@ def tests_unit(session):
 @nox.session
 def tests_integration(session):
     session.install("poetry")
-    session.run("poetry", "install")
+    session.run("poetry", "install", "--extras", "redis")
     os.chdir("tests")
     session.run("docker-compose", "up", "-d", external=True)
     session.run("sleep", "30", external=True)
     session.run("python", "-m", "pytest", "-s", "-v", "integration")
     session.run("docker-compose", "down", external=True)
+
+
+@nox.session
+def benchmarks(session):
+    session.install("poetry")
+    session.run("poetry", "install", "--extras", "redis")
+    session.run(
+        "python", "-m", "benchmarks.run", "--output", "benchmark.json", *session.posargs
+    )
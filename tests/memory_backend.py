@@ -0,0 +1,258 @@
+"""In memory backend used by the tests and the benchmarks."""
+import asyncio
+import itertools
+from collections import Counter
+from typing import Any, Dict, List
+
+from application import mongo, search
+
+
+class MockedBackend:
+    """In memory stand in for MongoBackend, every call takes `latency` seconds."""
+
+    def __init__(self, books: List[Dict[str, Any]], latency: float = 0.1):
+        self.books = books
+        self.latency = latency
+        # Book counts kept by the writes, as if they had been backfilled
+        self.authors = Counter(book["author"] for book in books)
+        self.genres = Counter(
+            itertools.chain.from_iterable(book["genres"] for book in books)
+        )
+        self.text_index = search.TextIndex(mongo.TEXT_INDEX_WEIGHTS)
+        for book in self.books:
+            self.text_index.add(book["book_id"], book)
+        self.open_connections = 0
+        self.closed = False
+        self.catalog_version = 0
+        self.last_write = None
+
+    async def ping(self):
+        await asyncio.sleep(self.latency)
+
+    async def warm_up(self, connections):
+        await asyncio.sleep(self.latency)
+        self.open_connections = max(self.open_connections, connections)
+
+    def pool_stats(self):
+        return {"open_connections": self.open_connections, "checked_out_connections": 0}
+
+    def close(self):
+        self.closed = True
+
+    def advance_last_write(self, last_write):
+        if last_write is not None:
+            self.last_write = last_write
+
+    async def get_catalog_version(self):
+        await asyncio.sleep(self.latency)
+        return self.catalog_version
+
+    async def increment_catalog_version(self):
+        await asyncio.sleep(self.latency)
+        self.catalog_version += 1
+        return self.catalog_version
+
+    async def get_total_number_of_books(
+        self, authors, genres, published_year, limit=None
+    ):
+        await asyncio.sleep(self.latency)
+        count = len(self._filter_books(authors, genres, published_year))
+        return min(count, limit) if limit is not None else count
+
+    async def get_estimated_number_of_books(self):
+        await asyncio.sleep(self.latency)
+        return len(self.books)
+
+    @staticmethod
+    def _project(books, fields):
+        projection = mongo.LIST_FIELDS + (fields or [])
+        return [
+            {field: book[field] for field in projection if field in book}
+            for book in books
+        ]
+
+    def _filter_books(self, authors, genres, published_year):
+        books = []
+        for book in sorted(self.books, key=lambda book: book["name"]):
+            if authors is not None and book["author"] not in authors:
+                continue
+            if genres is not None and not set(book["genres"]).intersection(genres):
+                continue
+            if published_year is not None and book["published_year"] != published_year:
+                continue
+            books.append(book)
+        return books
+
+    async def get_all_books(
+        self,
+        skips,
+        number_of_documents,
+        authors=None,
+        genres=None,
+        published_year=None,
+        fields=None,
+    ):
+        await asyncio.sleep(self.latency)
+        books = self._filter_books(authors, genres, published_year)
+        return self._project(books[skips : skips + number_of_documents], fields)
+
+    async def get_books_by_key(
+        self,
+        number_of_documents,
+        after=None,
+        before=None,
+        authors=None,
+        genres=None,
+        published_year=None,
+        fields=None,
+    ):
+        await asyncio.sleep(self.latency)
+        books = self._filter_books(authors, genres, published_year)
+        if before is not None:
+            books = [book for book in books if book["name"] < before]
+            return self._project(books[-number_of_documents:], fields)
+        if after is not None:
+            books = [book for book in books if book["name"] > after]
+        return self._project(books[:number_of_documents], fields)
+
+    async def get_books_with_total(
+        self,
+        number_of_documents,
+        skips=0,
+        after=None,
+        before=None,
+        authors=None,
+        genres=None,
+        published_year=None,
+        fields=None,
+    ):
+        await asyncio.sleep(self.latency)
+        books = self._filter_books(authors, genres, published_year)
+        total = len(books)
+        if before is not None:
+            books = [book for book in books if book["name"] < before]
+            return total, self._project(books[-number_of_documents:], fields)
+        if after is not None:
+            books = [book for book in books if book["name"] > after]
+        return total, self._project(books[skips : skips + number_of_documents], fields)
+
+    async def search_books(self, query, skips, number_of_documents, fields=None):
+        await asyncio.sleep(self.latency)
+        books_by_id = {book["book_id"]: book for book in self.books}
+        matches = sorted(
+            self.text_index.search(query),
+            key=lambda match: (-match[1], books_by_id[match[0]]["name"]),
+        )
+        books = [
+            books_by_id[book_id]
+            for book_id, _ in matches[skips : skips + number_of_documents]
+        ]
+        return len(matches), self._project(books, fields)
+
+    async def iter_books(
+        self,
+        batch_size,
+        authors=None,
+        genres=None,
+        published_year=None,
+        projection=None,
+    ):
+        books = self._filter_books(authors, genres, published_year)
+        for start in range(0, len(books), batch_size):
+            await asyncio.sleep(self.latency)
+            for book in books[start : start + batch_size]:
+                yield book
+
+    @staticmethod
+    def _get_facet(counts, limit, after, sort_by_count):
+        facets = [{"name": name, "book_count": count} for name, count in counts.items()]
+        if sort_by_count:
+            facets.sort(key=lambda facet: (-facet["book_count"], facet["name"]))
+            if after is not None:
+                after_key = (-after["book_count"], after["name"])
+                facets = [
+                    facet
+                    for facet in facets
+                    if (-facet["book_count"], facet["name"]) > after_key
+                ]
+        else:
+            facets.sort(key=lambda facet: facet["name"])
+            if after is not None:
+                facets = [facet for facet in facets if facet["name"] > after["name"]]
+        return facets[:limit] if limit is not None else facets
+
+    async def get_all_authors(self, limit=None, after=None, sort_by_count=False):
+        await asyncio.sleep(self.latency)
+        return self._get_facet(self.authors, limit, after, sort_by_count)
+
+    async def get_all_genres(self, limit=None, after=None, sort_by_count=False):
+        await asyncio.sleep(self.latency)
+        return self._get_facet(self.genres, limit, after, sort_by_count)
+
+    async def get_single_book_by_id(self, book_id: str):
+        await asyncio.sleep(self.latency)
+        for book in self.books:
+            if book["book_id"] == book_id:
+                return book
+
+    async def replace_one_book(self, book_id: str, data: Dict[str, Any], e_tag=None):
+        await asyncio.sleep(self.latency)
+        data["book_id"] = book_id
+        for index, book in enumerate(self.books):
+            if book["book_id"] != book_id:
+                continue
+            if e_tag is not None and book.get("eTag") not in (e_tag, None):
+                return None
+            self.books[index] = data
+            self.text_index.add(book_id, data)
+            return book
+
+    async def delete_one_book(self, book_id: str, e_tag=None):
+        await asyncio.sleep(self.latency)
+        for book in self.books:
+            if book["book_id"] != book_id:
+                continue
+            if e_tag is not None and book.get("eTag") not in (e_tag, None):
+                return None
+            self.books.remove(book)
+            self.text_index.remove(book_id)
+            return book
+
+    async def get_books_by_ids(self, book_ids: List[str]):
+        await asyncio.sleep(self.latency)
+        return [book for book in self.books if book["book_id"] in book_ids]
+
+    async def update_author_and_genre_counts(
+        self, authors: Dict[str, int], genres: Dict[str, int]
+    ):
+        await asyncio.sleep(self.latency)
+        for counts, changes in ((self.authors, authors), (self.genres, genres)):
+            counts.update(changes)
+            for name in [name for name, count in counts.items() if count <= 0]:
+                del counts[name]
+
+    async def get_single_book_by_name(self, name: str):
+        await asyncio.sleep(self.latency)
+        for book in self.books:
+            if book["name"] == name:
+                return book
+
+    async def insert_one_book(self, data: Dict[str, Any]):
+        await asyncio.sleep(self.latency)
+        name = data.get("name")
+        for book in self.books:
+            if name == book.get("name"):
+                raise mongo.BookExistsException()
+        self.books.append(data)
+        self.text_index.add(data["book_id"], data)
+
+    async def insert_many_books(self, books: List[Dict[str, Any]]):
+        await asyncio.sleep(self.latency)
+        existing = []
+        for index, data in enumerate(books):
+            if any(data["name"] == book["name"] for book in self.books):
+                existing.append(index)
+            else:
+                self.books.append(data)
+                self.text_index.add(data["book_id"], data)
+        return existing
@@ -1,10 +1,23 @@
+import asyncio
+import json
 import string
 from datetime import datetime
 
+import fakeredis
 import pytest
+from fakeredis import aioredis
+from fastapi import Response
 from fastapi.testclient import TestClient
 
-from application import app, mongo
+from application import (
+    app,
+    cache,
+    invalidation,
+    models,
+    mongo,
+    routers,
+    settings,
+)
 
 client = TestClient(app)
 
@@ -141,7 +154,7 @@ def test_get_all_books_in_db(backend):
     books_in_first_page = response.json()["books"]
     assert len(books_in_first_page) == 3
     assert "next_page" in response.json()
-    assert "page=2" in response.json()["next_page"]
+    assert "cursor=" in response.json()["next_page"]
 
 
 @pytest.mark.get_all_books
@@ -158,6 +171,14 @@ def test_get_all_books_in_db_second_page(backend):
     assert "page=1" in response.json()["prev_page"]
 
 
+@pytest.mark.get_all_books
+@pytest.mark.parametrize("page", [0, -1])
+def test_get_all_books_with_an_invalid_page(backend, page):
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get(f"/books?page={page}")
+    assert response.status_code == 422
+
+
 @pytest.mark.add_a_book
 def test_that_a_book_with_missing_fields_fails_to_add(backend):
     mongo.BACKEND = backend(books=all_books)
@@ -274,3 +295,676 @@ def test_update_a_single_book(backend):
     # get the book again and check that etag has changed
     book_get_response = client.get("/book/book_4")
     assert book_get_response.headers.get("eTag") != "book_4"
+
+
+@pytest.mark.get_all_books
+def test_get_all_books_following_the_cursor(backend):
+    mongo.BACKEND = backend(books=all_books)
+    first_page = client.get("/books").json()
+    assert [book["name"] for book in first_page["books"]] == [
+        "Master of the game",
+        "Tell me your dreams",
+        "The eye of the needle",
+    ]
+    assert "prev_page" not in first_page
+
+    second_page = client.get(first_page["next_page"]).json()
+    assert second_page["total_results"] == 4
+    assert [book["name"] for book in second_page["books"]] == [
+        "The pillars of the earth"
+    ]
+    assert "next_page" not in second_page
+    assert "cursor=" in second_page["prev_page"]
+
+    previous_page = client.get(second_page["prev_page"]).json()
+    assert previous_page["books"] == first_page["books"]
+    assert "prev_page" not in previous_page
+    assert "next_page" in previous_page
+
+
+@pytest.mark.get_all_books
+def test_get_all_books_with_filter_keeps_filter_in_cursor_links(backend):
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get("/books?authors=Sidney Sheldon,Ken Follet")
+    assert response.status_code == 200
+    assert "authors=Sidney+Sheldon,Ken+Follet" in response.json()["next_page"]
+
+
+@pytest.mark.get_all_books
+def test_get_all_books_with_invalid_cursor(backend):
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get("/books?cursor=not-a-cursor")
+    assert response.status_code == 400
+    assert response.json() == {"message": "Invalid cursor!!"}
+
+
+@pytest.mark.get_all_books
+def test_get_all_books_counts_only_when_the_count_is_not_cached(backend):
+    mongo.BACKEND = backend(books=all_books)
+    assert client.get("/books").json()["total_results"] == 4
+    mongo.BACKEND.books.pop()
+    # The cached count is used, only the page itself is fetched again
+    assert client.get("/books").json()["total_results"] == 4
+    routers.COUNT_CACHE.clear()
+    assert client.get("/books").json()["total_results"] == 3
+
+
+@pytest.mark.get_all_books
+def test_get_all_books_does_not_cache_a_count_read_before_a_write(backend):
+    mongo.BACKEND = backend(books=all_books)
+    get_books_with_total = mongo.BACKEND.get_books_with_total
+
+    async def get_books_with_total_during_a_delete(**query):
+        result = await get_books_with_total(**query)
+        # Another worker deletes a book after the count was read
+        book = mongo.BACKEND.books.pop(0)
+        invalidation.deliver(routers.invalidation_message(removed=[book]))
+        return result
+
+    mongo.BACKEND.get_books_with_total = get_books_with_total_during_a_delete
+    assert client.get("/books").json()["total_results"] == 4
+    mongo.BACKEND.get_books_with_total = get_books_with_total
+    response = client.get("/books").json()
+    assert response["total_results"] == 3
+    assert "Tell me your dreams" not in [book["name"] for book in response["books"]]
+
+
+@pytest.mark.get_all_books
+def test_get_all_books_with_page_size(backend):
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get("/books?page_size=2")
+    assert len(response.json()["books"]) == 2
+    assert "page_size=2" in response.json()["next_page"]
+    assert client.get("/books?page_size=0").status_code == 422
+    assert client.get("/books?page_size=101").status_code == 422
+
+
+@pytest.mark.get_all_books
+def test_get_all_books_serves_the_prefetched_next_page(backend):
+    mongo.BACKEND = backend(books=all_books)
+    first_page = client.get("/books?page_size=2").json()
+
+    async def fail(*args, **kwargs):
+        raise AssertionError("The page should have been prefetched")
+
+    mongo.BACKEND.get_books_by_key = fail
+    mongo.BACKEND.get_books_with_total = fail
+    second_page = client.get(first_page["next_page"]).json()
+    assert [book["name"] for book in second_page["books"]] == [
+        "The eye of the needle",
+        "The pillars of the earth",
+    ]
+    assert "next_page" not in second_page
+
+
+@pytest.mark.get_all_books
+def test_get_all_books_with_an_approximate_count(backend):
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get("/books?count=approximate")
+    assert response.json()["total_results"] == 4
+    assert "total_results_is_lower_bound" not in response.json()
+    assert "count=approximate" in response.json()["next_page"]
+    assert len(routers.COUNT_CACHE) == 0
+
+
+@pytest.mark.get_all_books
+def test_get_all_books_with_a_capped_count(backend, monkeypatch):
+    monkeypatch.setattr(routers.settings, "COUNT_CAP", 2)
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get("/books?count=capped&page_size=1&page=1").json()
+    assert response["total_results"] == 2
+    assert response["total_results_is_lower_bound"] is True
+    assert "page=2" in response["next_page"]
+
+    # The next page is found from the books, not from the capped count
+    response = client.get("/books?count=capped&page_size=1&page=3").json()
+    assert response["total_results"] == 4
+    assert [book["name"] for book in response["books"]] == ["The eye of the needle"]
+    assert "page=4" in response["next_page"]
+
+
+@pytest.mark.get_all_books
+def test_get_all_books_with_an_unknown_count_mode(backend):
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get("/books?count=roughly")
+    assert response.status_code == 400
+
+
+@pytest.mark.delete_single_book
+def test_delete_book_updates_the_total_number_of_books(backend):
+    mongo.BACKEND = backend(books=all_books)
+    assert client.get("/books?authors=Ken Follet").json()["total_results"] == 2
+    assert client.get("/books?authors=Sidney Sheldon").json()["total_results"] == 2
+    assert client.delete("/book/book_1").status_code == 200
+    assert client.get("/books?authors=Ken Follet").json()["total_results"] == 2
+    assert client.get("/books?authors=Sidney Sheldon").json()["total_results"] == 1
+    assert client.get("/books").json()["total_results"] == 3
+
+
+@pytest.mark.get_single_book
+def test_get_single_book_with_correct_etag_is_served_from_the_cache(backend):
+    mongo.BACKEND = backend(books=all_books)
+    assert client.get("/book/book_1").status_code == 200
+    mongo.BACKEND = backend(books=[])
+    response = client.get("/book/book_1", headers={"If-None-Match": "book_1"})
+    assert response.status_code == 304
+
+
+@pytest.mark.delete_single_book
+def test_deleted_book_is_evicted_from_the_cache(backend):
+    mongo.BACKEND = backend(books=all_books)
+    assert client.get("/book/book_1").status_code == 200
+    assert client.delete("/book/book_1").status_code == 200
+    assert client.get("/book/book_1").status_code == 400
+
+
+@pytest.mark.update_a_book
+def test_the_slower_of_two_concurrent_updates_does_not_cache_its_book(backend):
+    mongo.BACKEND = backend(books=all_books)
+    update_counts = mongo.BACKEND.update_author_and_genre_counts
+    delays = [0.3, 0]
+
+    async def update_counts_slowly_first(authors, genres):
+        await asyncio.sleep(delays.pop(0))
+        await update_counts(authors, genres)
+
+    mongo.BACKEND.update_author_and_genre_counts = update_counts_slowly_first
+    books = [
+        models.Book(
+            name=name,
+            author="Ken Follet",
+            genres=["Fiction"],
+            description="Some description",
+            published_year="1989",
+        )
+        for name in ("First", "Second")
+    ]
+
+    async def update_concurrently():
+        await asyncio.gather(
+            *(
+                routers.update_a_book("book_4", book, Response(), if_match=None)
+                for book in books
+            )
+        )
+
+    asyncio.run(update_concurrently())
+    assert mongo.BACKEND.books[-1]["name"] == "Second"
+    assert client.get("/book/book_4").json()["name"] == "Second"
+
+
+@pytest.mark.update_a_book
+def test_updates_leave_no_book_in_the_cache_shared_by_the_workers(backend, monkeypatch):
+    mongo.BACKEND = backend(books=all_books)
+    server = fakeredis.FakeServer()
+    shared_caches = [
+        cache.RedisSharedCache(aioredis.FakeRedis(server=server)) for _ in range(2)
+    ]
+    monkeypatch.setattr(routers, "SHARED_CACHE", shared_caches[0])
+    monkeypatch.setattr(
+        routers,
+        "BOOK_CACHE",
+        cache.TwoTierCache(cache.LRUCache(), shared_caches[0], "book", ttl=60),
+    )
+    book_to_update = {
+        "name": "First",
+        "author": "Ken Follet",
+        "genres": ["Fiction"],
+        "description": "Some description",
+        "published_year": "1989",
+    }
+    assert client.put("/book/book_4", json=book_to_update).status_code == 200
+
+    # Another worker finds nothing, it reads the book from the database
+    other_worker = cache.TwoTierCache(
+        cache.LRUCache(), shared_caches[1], "book", ttl=60
+    )
+    assert asyncio.run(other_worker.get("book_4")) is None
+    assert client.get("/book/book_4").json()["name"] == "First"
+    assert asyncio.run(other_worker.get("book_4"))["name"] == "First"
+
+
+@pytest.mark.update_a_book
+def test_update_a_single_book_with_an_outdated_etag_fails(backend):
+    mongo.BACKEND = backend(books=all_books)
+    book_to_update = {
+        "name": "The pillars of the earth",
+        "author": "ken follet",
+        "genres": ["Fiction", "Thriller"],
+        "description": "Some new description",
+        "published_year": "1998",
+    }
+    first_response = client.put(
+        "/book/book_4", json=book_to_update, headers={"If-Match": "book_4"}
+    )
+    assert first_response.status_code == 200
+    assert first_response.json()["author"] == "Ken Follet"
+    second_response = client.put(
+        "/book/book_4", json=book_to_update, headers={"If-Match": "book_4"}
+    )
+    assert second_response.status_code == 412
+
+
+@pytest.mark.delete_single_book
+def test_delete_last_book_of_an_author_removes_the_author(backend):
+    mongo.BACKEND = backend(books=all_books)
+    assert client.delete("/book/book_1").status_code == 200
+    assert client.get("/authors?with_counts=true").json() == [
+        {"name": "Ken Follet", "book_count": 2},
+        {"name": "Sidney Sheldon", "book_count": 1},
+    ]
+    assert client.delete("/book/book_3").status_code == 200
+    assert client.get("/authors?with_counts=true").json() == [
+        {"name": "Ken Follet", "book_count": 2}
+    ]
+
+
+@pytest.mark.add_a_book
+def test_adding_books_in_bulk(backend):
+    mongo.BACKEND = backend(books=all_books)
+    body = "\n".join(
+        [
+            '{"name": "Book 1", "author": "author one", "genres": ["Fiction"], '
+            '"description": "Some description", "published_year": "2001"}',
+            '{"name": "Book 2", "author": "Author two"}',
+            '{"name": "Tell me your dreams", "author": "Sidney Sheldon", '
+            '"genres": ["Fiction"], "description": "Some description", '
+            '"published_year": "1997"}',
+            "not json",
+        ]
+    )
+    response = client.post(
+        "/books/bulk", data=body, headers={"Content-Type": "application/x-ndjson"}
+    )
+    assert response.status_code == 200
+    report = response.json()
+    assert report["inserted"] == 1
+    assert [error["row"] for error in report["errors"]] == [2, 3, 4]
+    assert report["errors"][1]["message"] == "Book Tell me your dreams already exists!!"
+    added_book = next(book for book in mongo.BACKEND.books if book["name"] == "Book 1")
+    assert added_book["author"] == "Author One"
+    assert "book_id" in added_book and "eTag" in added_book
+    response = client.get("/authors?with_counts=true&sort=count")
+    assert response.json() == [
+        {"name": "Ken Follet", "book_count": 2},
+        {"name": "Sidney Sheldon", "book_count": 2},
+        {"name": "Author One", "book_count": 1},
+    ]
+
+
+@pytest.mark.get_all_books
+def test_export_books_with_filter(backend):
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get("/books/export?authors=Ken Follet")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    exported_books = [json.loads(line) for line in response.text.splitlines()]
+    assert [book["name"] for book in exported_books] == [
+        "The eye of the needle",
+        "The pillars of the earth",
+    ]
+    assert exported_books[0]["published_year"] == "2000"
+    assert exported_books[0]["book_id"] == "book_2"
+
+
+@pytest.mark.get_all_books
+def test_get_all_books_with_extra_fields(backend):
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get("/books?fields=published_year,genres")
+    assert response.status_code == 200
+    assert response.json()["books"][0] == {
+        "name": "Master of the game",
+        "author": "Sidney Sheldon",
+        "link": f"{models.base_uri()}book/book_3",
+        "published_year": "1997",
+        "genres": ["Fiction", "Thriller"],
+    }
+    assert "fields=published_year,genres" in response.json()["next_page"]
+    # Without fields only the name, author and link are in the response
+    assert set(client.get("/books").json()["books"][0]) == {"name", "author", "link"}
+
+
+@pytest.mark.get_all_books
+def test_get_all_books_with_unknown_fields(backend):
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get("/books?fields=eTag")
+    assert response.status_code == 400
+
+
+def test_get_authors_with_counts_sorted_by_count(backend):
+    books = all_books + [
+        {**all_books[0], "name": "Bloodline", "book_id": "book_5", "genres": ["Crime"]}
+    ]
+    mongo.BACKEND = backend(books=books)
+    response = client.get("/authors?with_counts=true&sort=count")
+    assert response.status_code == 200
+    assert response.json() == [
+        {"name": "Sidney Sheldon", "book_count": 3},
+        {"name": "Ken Follet", "book_count": 2},
+    ]
+
+
+def test_get_genres_page_by_page(backend):
+    books = all_books + [
+        {**all_books[0], "name": "Bloodline", "book_id": "book_5", "genres": ["Crime"]}
+    ]
+    mongo.BACKEND = backend(books=books)
+    response = client.get("/genres?limit=2&sort=count&with_counts=true")
+    assert response.json() == [
+        {"name": "Fiction", "book_count": 4},
+        {"name": "Thriller", "book_count": 4},
+    ]
+    next_page_url = response.headers["Link"].split(";")[0].strip("<>")
+    response = client.get(next_page_url)
+    assert response.json() == [{"name": "Crime", "book_count": 1}]
+    assert "Link" not in response.headers
+
+
+def test_update_a_book_moves_the_author_and_genre_counts(backend):
+    mongo.BACKEND = backend(books=all_books)
+    book_to_update = {
+        "name": "The pillars of the earth",
+        "author": "Ken Follett",
+        "genres": ["Fiction", "Historical"],
+        "description": "Some description",
+        "published_year": "1989",
+    }
+    response = client.put("/book/book_4", json=book_to_update)
+    assert response.status_code == 200
+    assert client.get("/authors?with_counts=true").json() == [
+        {"name": "Ken Follet", "book_count": 1},
+        {"name": "Ken Follett", "book_count": 1},
+        {"name": "Sidney Sheldon", "book_count": 2},
+    ]
+    assert client.get("/genres?with_counts=true").json() == [
+        {"name": "Fiction", "book_count": 4},
+        {"name": "Historical", "book_count": 1},
+        {"name": "Thriller", "book_count": 3},
+    ]
+
+
+def test_search_books_by_relevance(backend):
+    books = [
+        {**all_books[0], "description": "A tale of the dreams of a master"},
+        *all_books[1:],
+    ]
+    mongo.BACKEND = backend(books=books)
+    response = client.get("/books/search?q=master dreams")
+    assert response.status_code == 200
+    assert response.json()["total_results"] == 2
+    assert [book["name"] for book in response.json()["books"]] == [
+        "Tell me your dreams",
+        "Master of the game",
+    ]
+
+
+def test_search_books_page_by_page(backend):
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get("/books/search?q=description")
+    assert response.json()["total_results"] == 4
+    assert len(response.json()["books"]) == 3
+    response = client.get(response.json()["next_page"])
+    assert len(response.json()["books"]) == 1
+    assert "page=1" in response.json()["prev_page"]
+
+
+def test_autocomplete_is_kept_current_by_writes(backend):
+    mongo.BACKEND = backend(books=all_books)
+    asyncio.run(routers.build_autocomplete_indexes())
+    assert client.get("/autocomplete?prefix=the").json() == [
+        "The eye of the needle",
+        "The pillars of the earth",
+    ]
+    assert client.get("/autocomplete?prefix=s&kind=author").json() == ["Sidney Sheldon"]
+    assert client.delete("/book/book_2").status_code == 200
+    book_to_add = {
+        "name": "Theodore",
+        "author": "stephen king",
+        "genres": ["Fiction"],
+        "description": "some description",
+        "published_year": "2000",
+    }
+    assert client.post("/books", json=book_to_add).status_code == 201
+    assert client.get("/autocomplete?prefix=the").json() == [
+        "The pillars of the earth",
+        "Theodore",
+    ]
+    assert client.get("/autocomplete?prefix=s&kind=author").json() == [
+        "Sidney Sheldon",
+        "Stephen King",
+    ]
+    assert client.get("/autocomplete?prefix=s&kind=genre").status_code == 400
+
+
+def test_get_books_by_ids_keeps_the_order_and_reports_missing_books(backend):
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get("/books/batch?ids=book_3,book_100,book_1,book_3")
+    assert response.status_code == 200
+    books = response.json()["books"]
+    assert [book["eTag"] for book in books] == ["book_3", "book_1"]
+    assert books[1]["link"].endswith("book_1")
+    books[1].pop("eTag")
+    _check_book_correctness_book_1(books[1])
+    assert response.json()["missing"] == ["book_100"]
+
+
+def test_post_books_by_ids_uses_the_cached_books(backend):
+    mongo.BACKEND = backend(books=all_books)
+    assert client.get("/book/book_2").status_code == 200
+    mongo.BACKEND = backend(books=all_books[2:])
+    response = client.post("/books/batch", json={"ids": ["book_2", "book_4", "book_1"]})
+    assert response.status_code == 200
+    assert [book["name"] for book in response.json()["books"]] == [
+        "The eye of the needle",
+        "The pillars of the earth",
+    ]
+    assert response.json()["missing"] == ["book_1"]
+
+
+def test_get_too_many_books_by_ids(backend):
+    mongo.BACKEND = backend(books=all_books)
+    ids = ",".join(f"book_{number}" for number in range(1000))
+    assert client.get(f"/books/batch?ids={ids}").status_code == 400
+
+
+def test_post_accepts_longer_lists_of_ids_than_get(backend, monkeypatch):
+    mongo.BACKEND = backend(books=all_books)
+    monkeypatch.setattr(settings, "BATCH_MAX_BOOKS", 2)
+    monkeypatch.setattr(settings, "BATCH_MAX_BOOKS_POST", 3)
+    ids = ["book_1", "book_2", "book_3"]
+    assert client.get(f"/books/batch?ids={','.join(ids)}").status_code == 400
+    response = client.post("/books/batch", json={"ids": ids})
+    assert [book["name"] for book in response.json()["books"]] == [
+        "Tell me your dreams",
+        "The eye of the needle",
+        "Master of the game",
+    ]
+    response = client.post("/books/batch", json={"ids": [*ids, "book_4"]})
+    assert response.status_code == 400
+
+
+def test_liveness():
+    response = client.get("/health/live")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok"}
+
+
+def test_readiness_waits_for_the_warm_up(backend, monkeypatch):
+    monkeypatch.setattr(routers, "WARMED_UP", False)
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["status"] == "unavailable"
+
+    asyncio.run(routers.warm_up())
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    pool, caches = response.json()["pool"], response.json()["caches"]
+    assert pool["open_connections"] == routers.settings.WARMUP_CONNECTIONS
+    assert caches["counts"] == 1
+    assert caches["pages"] == 1
+    assert caches["facets"] == 2
+
+
+def test_warm_up_serves_the_first_requests_from_the_caches(backend, monkeypatch):
+    monkeypatch.setattr(routers, "WARMED_UP", False)
+    mongo.BACKEND = backend(books=all_books)
+    asyncio.run(routers.warm_up())
+
+    async def fail(*args, **kwargs):
+        raise AssertionError("The caches should have been warmed up")
+
+    mongo.BACKEND.get_all_authors = fail
+    mongo.BACKEND.get_books_with_total = fail
+    mongo.BACKEND.get_books_by_key = fail
+    assert client.get("/authors").json() == ["Ken Follet", "Sidney Sheldon"]
+    response = client.get("/books").json()
+    assert response["total_results"] == 4
+    assert len(response["books"]) == 3
+
+
+def test_shutdown_closes_the_client(backend):
+    mongo.BACKEND = backend(books=all_books)
+    asyncio.run(mongo.close_backend())
+    assert mongo.BACKEND.closed
+
+
+def test_writes_of_other_workers_invalidate_the_caches(backend):
+    mongo.BACKEND = backend(books=all_books)
+    assert client.get("/books").json()["total_results"] == 4
+    assert client.get("/book/book_1").status_code == 200
+    asyncio.run(routers.build_autocomplete_indexes())
+
+    # Another worker deletes a book, only its message reaches this worker
+    book = mongo.BACKEND.books.pop(0)
+    invalidation.deliver(routers.invalidation_message(removed=[book]))
+    assert client.get("/books").json()["total_results"] == 3
+    assert client.get("/book/book_1").status_code == 400
+    assert client.get("/autocomplete?prefix=tell").json() == []
+
+
+class RecordingBus(invalidation.InvalidationBus):
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, message):
+        self.published.append(message)
+
+
+def test_a_write_is_published_when_the_version_cannot_be_incremented_after_it(
+    backend, monkeypatch
+):
+    mongo.BACKEND = backend(books=all_books)
+    bus = RecordingBus()
+    monkeypatch.setattr(invalidation, "BUS", bus)
+    response = client.get("/books")
+    assert response.json()["total_results"] == 4
+    assert client.get("/book/book_1").status_code == 200
+    increment_catalog_version = mongo.BACKEND.increment_catalog_version
+    calls = 0
+
+    async def fail_after_the_write():
+        nonlocal calls
+        calls += 1
+        if calls > 1:
+            raise ConnectionError("The catalog version could not be incremented")
+        return await increment_catalog_version()
+
+    mongo.BACKEND.increment_catalog_version = fail_after_the_write
+    assert client.delete("/book/book_1").status_code == 200
+    assert client.get("/book/book_1").status_code == 400
+    # Incremented before the write, the lists served before it are not reused
+    headers = {"If-None-Match": response.headers["ETag"]}
+    assert client.get("/books", headers=headers).json()["total_results"] == 3
+    assert [message["version"] for message in bus.published] == [None]
+    assert bus.published[0]["removed"][0]["book_id"] == "book_1"
+
+
+def test_a_write_fails_before_changing_books_without_a_new_version(backend):
+    mongo.BACKEND = backend(books=all_books)
+
+    async def fail():
+        raise ConnectionError("The catalog version could not be incremented")
+
+    mongo.BACKEND.increment_catalog_version = fail
+    with pytest.raises(ConnectionError):
+        client.delete("/book/book_1")
+    assert client.get("/book/book_1").status_code == 200
+
+
+def test_lost_invalidations_rebuild_the_autocomplete_indexes(backend):
+    mongo.BACKEND = backend(books=all_books)
+    asyncio.run(routers.build_autocomplete_indexes())
+    # Written by another worker, whose invalidation never arrived
+    mongo.BACKEND.books.append({**all_books[0], "name": "Theodore", "book_id": "5"})
+
+    async def lose_invalidations():
+        invalidation.deliver({"clear": True})
+        await routers.AUTOCOMPLETE_REBUILD
+
+    asyncio.run(lose_invalidations())
+    assert client.get("/autocomplete?prefix=the").json() == [
+        "The eye of the needle",
+        "The pillars of the earth",
+        "Theodore",
+    ]
+
+
+def test_rebuilding_the_autocomplete_indexes_keeps_concurrent_writes(backend):
+    mongo.BACKEND = backend(books=all_books)
+    iter_books = mongo.BACKEND.iter_books
+    theodore = {**all_books[0], "name": "Theodore", "book_id": "book_5"}
+
+    async def iter_books_during_writes(**kwargs):
+        async for book in iter_books(**kwargs):
+            if book["book_id"] == "book_1":
+                # Written once the books to read are known, which misses it
+                mongo.BACKEND.books.append(theodore)
+                invalidation.deliver(routers.invalidation_message(added=[theodore]))
+                # Already read, it must not be counted twice
+                invalidation.deliver(routers.invalidation_message(added=[book]))
+            yield book
+
+    mongo.BACKEND.iter_books = iter_books_during_writes
+    asyncio.run(routers.build_autocomplete_indexes())
+    assert client.get("/autocomplete?prefix=t").json() == [
+        "Tell me your dreams",
+        "The eye of the needle",
+        "The pillars of the earth",
+        "Theodore",
+    ]
+    invalidation.deliver(routers.invalidation_message(removed=[all_books[0]]))
+    assert "Tell me your dreams" not in client.get("/autocomplete?prefix=t").json()
+    assert routers.AUTOCOMPLETE_PENDING == []
+
+
+def test_get_authors_answers_304_until_the_catalog_changes(backend):
+    mongo.BACKEND = backend(books=all_books)
+    response = client.get("/authors")
+    etag = response.headers["ETag"]
+    assert etag.startswith('W/"0-')
+    assert "stale-while-revalidate=" in response.headers["Cache-Control"]
+
+    async def fail(*args, **kwargs):
+        raise AssertionError("A 304 must not query the database")
+
+    get_all_authors, mongo.BACKEND.get_all_authors = mongo.BACKEND.get_all_authors, fail
+    response = client.get("/authors", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    mongo.BACKEND.get_all_authors = get_all_authors
+    client.delete("/book/book_1", headers={"If-Match": "book_1"})
+    response = client.get("/authors", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+@pytest.mark.get_all_books
+def test_get_all_books_etag_depends_on_the_query(backend):
+    mongo.BACKEND = backend(books=all_books)
+    etag = client.get("/books").headers["ETag"]
+    assert client.get("/books?page_size=2").headers["ETag"] != etag
+    response = client.get("/books", headers={"If-None-Match": f'{etag}, W/"1-x"'})
+    assert response.status_code == 304
+    assert client.get("/genres").headers["ETag"] != etag
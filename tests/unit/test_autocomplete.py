@@ -0,0 +1,28 @@
+from application import autocomplete
+
+
+def test_complete_ignores_case_and_respects_the_limit():
+    index = autocomplete.PrefixIndex()
+    index.add_many(["The eye of the needle", "Tell me your dreams", "the Testament"])
+    index.add("Master of the game")
+    assert index.complete("the", limit=10) == [
+        "The eye of the needle",
+        "the Testament",
+    ]
+    assert index.complete("T", limit=2) == [
+        "Tell me your dreams",
+        "The eye of the needle",
+    ]
+    assert index.complete("x", limit=10) == []
+
+
+def test_names_are_kept_until_removed_as_often_as_added():
+    index = autocomplete.PrefixIndex()
+    index.add("Ken Follet")
+    index.add_many(["Ken Follet", "Sidney Sheldon"])
+    index.remove("Ken Follet")
+    assert index.complete("ken", limit=10) == ["Ken Follet"]
+    index.remove("Ken Follet")
+    index.remove("Somebody else")
+    assert index.complete("ken", limit=10) == []
+    assert len(index) == 1
@@ -0,0 +1,60 @@
+import json
+
+from benchmarks import run
+
+
+def test_benchmark_saves_the_results_of_every_route(tmp_path):
+    output = tmp_path / "results.json"
+    argv = ["--latency", "0", "--books", "20", "--requests", "5", "--warmup", "1"]
+    assert run.main(argv + ["--output", str(output)]) == 0
+
+    results = json.loads(output.read_text())
+    assert results["meta"]["backend"] == "memory"
+    assert set(results["routes"]) == {
+        "GET /books",
+        "GET /books with filters",
+        "GET /books with page",
+        "GET /book/{book_id}",
+        "GET /book/{book_id} with If-None-Match",
+        "POST /books",
+        "PUT /book/{book_id}",
+        "DELETE /book/{book_id}",
+    }
+    for stats in results["routes"].values():
+        assert stats["requests"] == 5
+        assert stats["errors"] == 0
+        assert stats["p50_ms"] <= stats["p95_ms"] <= stats["p99_ms"]
+
+
+def test_percentile_uses_the_nearest_rank():
+    values = [float(value) for value in range(1, 101)]
+    assert run.percentile(values, 50) == 50
+    assert run.percentile(values, 99) == 99
+    assert run.percentile([3.0], 95) == 3
+    assert run.percentile([], 95) == 0
+
+
+def test_find_regressions_allows_the_tolerance():
+    baseline = {
+        "routes": {
+            "GET /books": {"p95_ms": 10, "p99_ms": 20, "throughput": 100, "errors": 0}
+        }
+    }
+    within = {
+        "routes": {
+            "GET /books": {"p95_ms": 11, "p99_ms": 21, "throughput": 90, "errors": 0},
+            "POST /books": {"p95_ms": 1, "p99_ms": 1, "throughput": 1, "errors": 0},
+        }
+    }
+    assert run.find_regressions(within, baseline, tolerance=0.2) == []
+
+    slower = {
+        "routes": {
+            "GET /books": {"p95_ms": 13, "p99_ms": 20, "throughput": 70, "errors": 1}
+        }
+    }
+    assert run.find_regressions(slower, baseline, tolerance=0.2) == [
+        "GET /books: p95_ms 13 > 10",
+        "GET /books: throughput 70 < 100",
+        "GET /books: errors 1 > 0",
+    ]
@@ -0,0 +1,223 @@
+import asyncio
+import pickle
+from datetime import datetime
+
+import fakeredis
+from fakeredis import aioredis
+
+from application import cache
+
+book = {
+    "name": "Tell me your dreams",
+    "author": "Sidney Sheldon",
+    "genres": ["Fiction", "Thriller"],
+    "published_year": datetime.strptime("1997", "%Y"),
+}
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_count_cache_entries_expire():
+    timer = FakeTimer()
+    count_cache = cache.CountCache(ttl=10, timer=timer)
+    key = count_cache.key()
+    count_cache.set(key, 4)
+    timer.now = 9
+    assert count_cache.get(key) == 4
+    timer.now = 10
+    assert count_cache.get(key) is None
+    assert len(count_cache) == 0
+
+
+def test_count_cache_is_bounded():
+    count_cache = cache.CountCache(maxsize=2)
+    count_cache.set(count_cache.key(authors=("A",)), 1)
+    count_cache.set(count_cache.key(authors=("B",)), 2)
+    count_cache.get(count_cache.key(authors=("A",)))
+    count_cache.set(count_cache.key(authors=("C",)), 3)
+    assert count_cache.get(count_cache.key(authors=("A",))) == 1
+    assert count_cache.get(count_cache.key(authors=("B",))) is None
+    assert count_cache.get(count_cache.key(authors=("C",))) == 3
+
+
+def test_count_cache_invalidates_only_matching_filters():
+    count_cache = cache.CountCache()
+    matching_keys = [
+        count_cache.key(),
+        count_cache.key(authors=("Sidney Sheldon", "Ken Follet")),
+        count_cache.key(genres=("Thriller",)),
+        count_cache.key(published_year=datetime.strptime("1997", "%Y")),
+        count_cache.key(authors=("Sidney Sheldon",), genres=("Fiction",)),
+    ]
+    other_keys = [
+        count_cache.key(authors=("Ken Follet",)),
+        count_cache.key(genres=("Romance",)),
+        count_cache.key(published_year=datetime.strptime("2000", "%Y")),
+        count_cache.key(authors=("Sidney Sheldon",), genres=("Romance",)),
+    ]
+    for key in matching_keys + other_keys:
+        count_cache.set(key, 1)
+
+    count_cache.invalidate(book)
+
+    assert all(count_cache.get(key) is None for key in matching_keys)
+    assert all(count_cache.get(key) == 1 for key in other_keys)
+
+
+def test_lru_cache_pop():
+    lru_cache = cache.LRUCache()
+    lru_cache.set("book_1", book)
+    assert lru_cache.get("book_1") == book
+    lru_cache.pop("book_1")
+    lru_cache.pop("book_2")
+    assert lru_cache.get("book_1") is None
+
+
+class Backend:
+    def __init__(self):
+        self.calls = 0
+
+    @cache.single_flight
+    async def get_books(self, authors=None):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if authors == ["Nobody"]:
+            raise LookupError()
+        return [{"author": author} for author in authors or []]
+
+
+def test_single_flight_shares_concurrent_identical_calls():
+    async def run():
+        backend = Backend()
+        results = await asyncio.gather(
+            backend.get_books(authors=["A"]),
+            backend.get_books(authors=["A"]),
+            backend.get_books(authors=["B"]),
+        )
+        assert results == [[{"author": "A"}], [{"author": "A"}], [{"author": "B"}]]
+        assert results[0] is results[1]
+        assert backend.calls == 2
+        # Calls which are not concurrent are not shared
+        await backend.get_books(authors=["A"])
+        assert backend.calls == 3
+
+    asyncio.run(run())
+
+
+def test_single_flight_shares_exceptions_and_survives_cancellation():
+    async def run():
+        backend = Backend()
+        first = asyncio.ensure_future(backend.get_books(authors=["A"]))
+        second = asyncio.ensure_future(backend.get_books(authors=["A"]))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == [{"author": "A"}]
+        results = await asyncio.gather(
+            backend.get_books(authors=["Nobody"]),
+            backend.get_books(authors=["Nobody"]),
+            return_exceptions=True,
+        )
+        assert all(isinstance(result, LookupError) for result in results)
+        assert backend.calls == 2
+
+    asyncio.run(run())
+
+
+def test_single_flight_does_not_share_calls_across_generations():
+    async def run():
+        backend = Backend()
+        first = asyncio.ensure_future(backend.get_books(authors=["A"]))
+        await asyncio.sleep(0)
+        cache.bump_generation()
+        await asyncio.gather(first, backend.get_books(authors=["A"]))
+        assert backend.calls == 2
+
+    asyncio.run(run())
+
+
+def test_two_tier_cache_shares_entries_between_workers():
+    async def run():
+        server = fakeredis.FakeServer()
+        shared_caches = [
+            cache.RedisSharedCache(aioredis.FakeRedis(server=server)) for _ in range(2)
+        ]
+        workers = [
+            cache.TwoTierCache(cache.LRUCache(), shared_cache, namespace="book", ttl=60)
+            for shared_cache in shared_caches
+        ]
+        await workers[0].set("book_1", book)
+        assert await workers[1].get("book_1") == book
+        assert len(workers[1]) == 1
+
+        # A write bumps the version, older entries can no longer be reached
+        await shared_caches[0].bump_version()
+        workers[1].clear()
+        shared_caches[1].forget_version()
+        assert await workers[1].get("book_1") is None
+        assert await workers[1].get_many(["book_1", "book_2"]) == [None, None]
+
+    asyncio.run(run())
+
+
+def test_two_tier_cache_without_a_shared_cache():
+    async def run():
+        two_tier_cache = cache.TwoTierCache(
+            cache.LRUCache(), cache.NoOpSharedCache(), namespace="book", ttl=60
+        )
+        await two_tier_cache.set("book_1", book)
+        assert await two_tier_cache.get("book_1") == book
+        two_tier_cache.pop("book_1")
+        assert await two_tier_cache.get("book_1") is None
+
+    asyncio.run(run())
+
+
+def test_two_tier_cache_skips_values_read_before_an_invalidation():
+    async def run():
+        two_tier_cache = cache.TwoTierCache(
+            cache.LRUCache(), cache.NoOpSharedCache(), namespace="book", ttl=60
+        )
+        generation = cache.GENERATION
+        cache.bump_generation()
+        await two_tier_cache.set("book_1", book, generation=generation)
+        assert await two_tier_cache.get("book_1") is None
+        await two_tier_cache.set("book_1", book, generation=cache.GENERATION)
+        assert await two_tier_cache.get("book_1") == book
+
+    asyncio.run(run())
+
+
+def test_two_tier_cache_ignores_shared_entries_which_are_not_bson():
+    class PoisonedSharedCache(cache.SharedCache):
+        async def get_many(self, keys):
+            return [pickle.dumps(book), cache.TwoTierCache._encode([book])]
+
+        async def _get_version(self):
+            return 1
+
+    two_tier_cache = cache.TwoTierCache(
+        cache.LRUCache(), PoisonedSharedCache(), namespace="page", ttl=60
+    )
+    assert asyncio.run(two_tier_cache.get_many(["page_1", "page_2"])) == [
+        None,
+        [book],
+    ]
+
+
+def test_redis_shared_cache_treats_errors_as_misses():
+    class BrokenClient:
+        async def mget(self, keys):
+            raise ConnectionError("Redis is down")
+
+        async def get(self, key):
+            raise ConnectionError("Redis is down")
+
+    shared_cache = cache.RedisSharedCache(BrokenClient())
+    assert asyncio.run(shared_cache.get_many(["key"])) == [None]
+    assert asyncio.run(shared_cache.version()) is None
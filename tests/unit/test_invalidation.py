@@ -0,0 +1,196 @@
+import asyncio
+import itertools
+
+import pytest
+from pymongo.errors import CollectionInvalid
+
+from application import invalidation
+
+
+def test_delivering_applies_the_message_to_the_subscribers(monkeypatch):
+    received = []
+    monkeypatch.setattr(invalidation, "SUBSCRIBERS", [received.append])
+    message = {"added": [], "removed": [], "clear": True}
+    invalidation.deliver(message)
+    # The publishing worker already applied it, there is nobody else to tell
+    asyncio.run(invalidation.InMemoryBus().publish(message))
+    assert received == [message]
+
+
+class InsertResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class TailableCursor:
+    """Like a tailable await cursor, which stops at the end without dying."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.position = 0
+        self.alive = True
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.collection.error is not None:
+            self.alive = False
+            raise self.collection.error
+        if self.alive and self.position < len(self.collection.documents):
+            self.position += 1
+            return self.collection.documents[self.position - 1]
+        await asyncio.sleep(0)
+        raise StopAsyncIteration
+
+
+class CappedCollection:
+    def __init__(self):
+        self.documents = []
+        self.cursors = []
+        self.error = None
+        self.ids = itertools.count()
+
+    async def insert_one(self, document):
+        document = {**document, "_id": next(self.ids)}
+        self.documents.append(document)
+        return InsertResult(document["_id"])
+
+    async def find_one(self, condition):
+        if self.error is not None:
+            raise self.error
+        return next(
+            (doc for doc in self.documents if doc["_id"] == condition["_id"]), None
+        )
+
+    def find(self, cursor_type):
+        self.cursors.append(TailableCursor(self))
+        return self.cursors[-1]
+
+    def overwrite_oldest(self, count):
+        """Drop the oldest documents, which kills the cursors reading them."""
+        del self.documents[:count]
+        for cursor in self.cursors:
+            cursor.alive = False
+
+
+class Database:
+    def __init__(self):
+        self.collection = CappedCollection()
+        self.created = False
+
+    async def create_collection(self, name, capped, size):
+        if self.created:
+            raise CollectionInvalid(f"collection {name} already exists")
+        self.created = True
+
+    def __getitem__(self, name):
+        return self.collection
+
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+
+def message(book_id):
+    return {"added": [], "removed": [{"book_id": book_id}], "clear": False}
+
+
+@pytest.fixture
+def received(monkeypatch):
+    received = []
+    monkeypatch.setattr(invalidation, "SUBSCRIBERS", [received.append])
+    return received
+
+
+def test_capped_collection_bus_delivers_only_newer_messages_of_other_workers(
+    received,
+):
+    database = Database()
+    collection = database.collection
+
+    async def run():
+        await collection.insert_one({"origin": "other", "message": message("old")})
+        bus = invalidation.CappedCollectionBus(database, "invalidations", 1024, 0)
+        await bus.start()
+        # The marker it starts from
+        assert collection.documents[-1]["message"] is None
+        await collection.insert_one({"origin": "other", "message": message("new")})
+        await settle()
+        assert received == [message("new")]
+
+        # Its own messages were applied before they were published
+        await bus.publish(message("own"))
+        await settle()
+        assert collection.documents[-1]["message"] == message("own")
+        assert received == [message("new")]
+        await bus.stop()
+
+        # Starting again, e.g. on a restart, finds the collection created
+        await bus.start()
+        await bus.stop()
+
+    asyncio.run(run())
+
+
+def test_capped_collection_bus_resumes_after_the_last_message_it_read(received):
+    database = Database()
+    collection = database.collection
+
+    async def run():
+        bus = invalidation.CappedCollectionBus(database, "invalidations", 1024, 0)
+        await bus.start()
+        await collection.insert_one({"origin": "other", "message": message("1")})
+        await settle()
+        collection.cursors[-1].alive = False
+        await collection.insert_one({"origin": "other", "message": message("2")})
+        await settle()
+        assert received == [message("1"), message("2")]
+        assert len(collection.cursors) == 2
+        await bus.stop()
+
+    asyncio.run(run())
+
+
+def test_capped_collection_bus_clears_the_caches_when_messages_are_lost(received):
+    database = Database()
+    collection = database.collection
+
+    async def run():
+        bus = invalidation.CappedCollectionBus(database, "invalidations", 1024, 0)
+        await bus.start()
+        await collection.insert_one({"origin": "other", "message": message("1")})
+        await settle()
+        # Newer messages overwrote every message the bus read
+        collection.overwrite_oldest(len(collection.documents))
+        await settle()
+        assert received == [message("1"), {"clear": True}]
+        # Tailing goes on from a new marker
+        assert collection.documents[-1]["message"] is None
+        await collection.insert_one({"origin": "other", "message": message("2")})
+        await settle()
+        assert received == [message("1"), {"clear": True}, message("2")]
+        await bus.stop()
+
+    asyncio.run(run())
+
+
+def test_capped_collection_bus_clears_the_caches_when_tailing_fails(received):
+    database = Database()
+    collection = database.collection
+
+    async def run():
+        bus = invalidation.CappedCollectionBus(database, "invalidations", 1024, 0)
+        await bus.start()
+        collection.error = ConnectionError("mongod is down")
+        await settle()
+        assert received[:1] == [{"clear": True}]
+        collection.error = None
+        await settle()
+        await collection.insert_one({"origin": "other", "message": message("1")})
+        await settle()
+        assert received[-1] == message("1")
+        await bus.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,60 @@
+from datetime import datetime
+
+from application import models
+
+books = [
+    {
+        "name": "Tell me your dreams",
+        "author": "Sidney Sheldon",
+        "genres": ["Fiction", "Thriller"],
+        "published_year": datetime.strptime("1997", "%Y"),
+        "description": "Some description",
+        "book_id": "book_1",
+        "eTag": "book_1",
+    },
+    {
+        "name": "The eye of the needle",
+        "author": "Ken Follet",
+        "genres": ["Fiction", "Thriller"],
+        "published_year": datetime.strptime("2000", "%Y"),
+        "description": "Some description",
+        "book_id": "book_2",
+        "eTag": "book_2",
+    },
+]
+
+
+def test_single_book_response_matches_the_response_model():
+    for book in books:
+        assert models.single_book_response(book) == models.SingleBookResponse(
+            **book
+        ).dict(exclude_unset=True)
+
+
+def test_all_books_response_matches_the_response_model():
+    for links in [
+        {},
+        {"next_page": "next"},
+        {"prev_page": "prev", "next_page": "next"},
+    ]:
+        fast_response = models.all_books_response(total_results=2, books=books, **links)
+        response = models.AllBooksResponse(total_results=2, books=books, **links)
+        assert fast_response == response.dict(exclude_unset=True)
+        assert list(fast_response) == list(response.dict(exclude_unset=True))
+
+
+def test_all_books_response_with_fields_matches_the_response_model():
+    fields = ["description", "genres", "published_year"]
+    fast_response = models.all_books_response(
+        total_results=2, books=books, fields=fields
+    )
+    response = models.AllBooksResponse(total_results=2, books=books)
+    for fast_book, book, book_in_db in zip(
+        fast_response["books"], response.dict()["books"], books
+    ):
+        assert fast_book == {
+            **book,
+            "description": book_in_db["description"],
+            "genres": book_in_db["genres"],
+            "published_year": book_in_db["published_year"].strftime("%Y"),
+        }
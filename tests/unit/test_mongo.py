@@ -0,0 +1,184 @@
+import asyncio
+import os
+
+import pytest
+from bson import Timestamp
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from application import mongo, settings
+
+
+def test_compare_indexes_reports_missing_and_extra_indexes():
+    indexes = mongo.INDEXES[mongo.BOOKS_COLLECTION]
+    report = mongo.MongoBackend.compare_indexes(
+        indexes, ["_id_", "name_1", "book_id_1", "description_1"]
+    )
+    assert report == {
+        "missing": [index.document["name"] for index in indexes[2:]],
+        "extra": ["description_1"],
+    }
+
+
+def test_compare_indexes_when_all_indexes_exist():
+    report = mongo.MongoBackend.compare_indexes(
+        mongo.INDEXES[mongo.AUTHORS_COLLECTION],
+        ["_id_", "name_1", "book_count_-1_name_1"],
+    )
+    assert report == {"missing": [], "extra": []}
+
+
+def test_list_read_preference_is_bounded_by_max_staleness(monkeypatch):
+    monkeypatch.setattr(settings, "MONGODB_LIST_READ_PREFERENCE", "secondaryPreferred")
+    monkeypatch.setattr(settings, "MONGODB_MAX_STALENESS_SECONDS", 120)
+    read_preference = mongo.get_list_read_preference()
+    assert read_preference.mongos_mode == "secondaryPreferred"
+    assert read_preference.max_staleness == 120
+
+    monkeypatch.setattr(settings, "MONGODB_LIST_READ_PREFERENCE", "primary")
+    assert mongo.get_list_read_preference().mongos_mode == "primary"
+
+
+def test_client_options_parse_the_write_concern(monkeypatch):
+    monkeypatch.setattr(settings, "MONGODB_WRITE_CONCERN", "2")
+    monkeypatch.setattr(settings, "MONGODB_SOCKET_TIMEOUT_MS", 0)
+    options = mongo.get_client_options()
+    assert options["w"] == 2
+    assert options["socketTimeoutMS"] is None
+    monkeypatch.setattr(settings, "MONGODB_WRITE_CONCERN", "majority")
+    assert mongo.get_client_options()["w"] == "majority"
+
+
+def test_backend_keeps_the_latest_write():
+    backend = mongo.MongoBackend(uri="mongodb://localhost:27017")
+    first = {"cluster_time": {}, "operation_time": Timestamp(10, 1)}
+    second = {"cluster_time": {}, "operation_time": Timestamp(10, 2)}
+    backend.advance_last_write(second)
+    backend.advance_last_write(first)
+    backend.advance_last_write(None)
+    assert backend.last_write is second
+    backend.close()
+
+
+class FakeCollection:
+    def __init__(self, write_errors=(), uncounted=None):
+        self.write_errors = list(write_errors)
+        self.uncounted = uncounted
+        self.bulk_writes = []
+        self.deletes = []
+        self.pipelines = []
+
+    async def bulk_write(self, requests, ordered):
+        self.bulk_writes.append(requests)
+        if self.write_errors:
+            raise BulkWriteError({"writeErrors": self.write_errors.pop(0)})
+
+    async def delete_many(self, condition):
+        self.deletes.append(condition)
+
+    async def find_one(self, condition):
+        return self.uncounted
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        return self
+
+    async def to_list(self, length):
+        return []
+
+
+def fake_backend(**collections):
+    backend = mongo.MongoBackend(uri="mongodb://localhost:27017")
+    backend.close()
+    backend._client = {mongo.DB: collections}
+    return backend
+
+
+def test_update_counts_retries_the_upserts_which_raced_on_the_unique_index():
+    authors = FakeCollection(
+        write_errors=[[{"index": 1, "code": mongo.DUPLICATE_KEY_ERROR}]]
+    )
+    backend = fake_backend(authors=authors)
+    changes = {"Sidney Sheldon": -1, "Ken Follet": 1}
+    asyncio.run(backend.update_author_and_genre_counts(authors=changes, genres={}))
+    assert authors.bulk_writes == [
+        [
+            UpdateOne({"name": "Sidney Sheldon"}, {"$inc": {"book_count": -1}}),
+            UpdateOne({"name": "Ken Follet"}, {"$inc": {"book_count": 1}}, upsert=True),
+        ],
+        # The other upsert created the author, only the increment is retried
+        [UpdateOne({"name": "Ken Follet"}, {"$inc": {"book_count": 1}})],
+    ]
+    assert authors.deletes == [
+        {"name": {"$in": ["Sidney Sheldon"]}, "book_count": {"$lte": 0}}
+    ]
+
+
+def test_update_counts_raises_other_write_errors():
+    genres = FakeCollection(write_errors=[[{"index": 0, "code": 121}]])
+    backend = fake_backend(genres=genres)
+    with pytest.raises(BulkWriteError):
+        asyncio.run(
+            backend.update_author_and_genre_counts(authors={}, genres={"Fiction": 1})
+        )
+    assert len(genres.bulk_writes) == 1
+
+
+def test_backfill_counts_only_the_collections_with_uncounted_names():
+    books = FakeCollection()
+    authors = FakeCollection(uncounted={"name": "Sidney Sheldon"})
+    genres = FakeCollection()
+    backend = fake_backend(books=books, authors=authors, genres=genres)
+    asyncio.run(backend.backfill_book_counts())
+    assert books.pipelines == [
+        [
+            {"$group": {"_id": "$author", "book_count": {"$sum": 1}}},
+            {"$project": {"_id": 0, "name": "$_id", "book_count": 1}},
+            {"$merge": {"into": "authors", "on": "name"}},
+        ]
+    ]
+    assert authors.deletes == [{"book_count": {"$exists": False}}]
+    assert genres.deletes == []
+
+
+def test_books_by_ids_are_looked_up_in_chunks(monkeypatch):
+    class BooksCollection:
+        def __init__(self):
+            self.conditions = []
+
+        def find(self, condition, projection):
+            self.conditions.append(condition)
+            return self._iterate(condition["book_id"]["$in"])
+
+        async def _iterate(self, book_ids):
+            for book_id in book_ids:
+                yield {"book_id": book_id}
+
+    monkeypatch.setattr(settings, "BATCH_IN_SIZE", 2)
+    books = BooksCollection()
+    backend = fake_backend(books=books)
+    book_ids = ["book_1", "book_2", "book_3"]
+    found = asyncio.run(backend.get_books_by_ids(book_ids))
+    assert [book["book_id"] for book in found] == book_ids
+    assert books.conditions == [
+        {"book_id": {"$in": ["book_1", "book_2"]}},
+        {"book_id": {"$in": ["book_3"]}},
+    ]
+
+
+@pytest.mark.skipif(
+    not os.getenv("MONGODB_TEST_URI"),
+    reason="Needs a replica set, e.g. a single node one, in MONGODB_TEST_URI",
+)
+def test_lists_read_after_a_write_include_it():
+    async def run():
+        backend = mongo.MongoBackend(uri=os.environ["MONGODB_TEST_URI"])
+        try:
+            await backend.increment_catalog_version()
+            assert backend.last_write is not None
+            # Causally consistent, even when answered by a secondary
+            await backend.get_all_authors()
+        finally:
+            backend.close()
+
+    asyncio.run(run())
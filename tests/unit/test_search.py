@@ -0,0 +1,27 @@
+from application import search
+
+index = search.TextIndex({"name": 10, "description": 1})
+index.add("book_1", {"name": "The eye of the needle", "description": "A spy story"})
+index.add("book_2", {"name": "Spy games", "description": "Needle and thread"})
+index.add("book_3", {"name": "Master of the game", "description": None})
+
+
+def test_tokenize_drops_stop_words_and_case():
+    assert search.tokenize("The Eye of the needle, again!") == [
+        "eye",
+        "needle",
+        "again",
+    ]
+
+
+def test_search_ranks_matches_in_the_name_first():
+    assert index.search("spy") == [("book_2", 10), ("book_1", 1)]
+    assert index.search("needle spy") == [("book_1", 11), ("book_2", 11)]
+    assert index.search("the of") == []
+
+
+def test_removed_documents_are_not_found():
+    index.add("book_4", {"name": "Spy", "description": "spy spy"})
+    assert index.search("spy")[0] == ("book_4", 12)
+    index.remove("book_4")
+    assert [book_id for book_id, _ in index.search("spy")] == ["book_2", "book_1"]
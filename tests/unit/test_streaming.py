@@ -0,0 +1,64 @@
+import asyncio
+
+from application import streaming
+
+
+def parse(*chunks, max_document_size=1024):
+    async def chunk_stream():
+        for chunk in chunks:
+            yield chunk
+
+    async def collect():
+        return [
+            (row, document.message)
+            if isinstance(document, streaming.InvalidDocument)
+            else (row, document)
+            async for row, document in streaming.iter_documents(
+                chunk_stream(), max_document_size=max_document_size
+            )
+        ]
+
+    return asyncio.run(collect())
+
+
+def test_parse_ndjson_split_across_chunks():
+    assert parse(b'{"a": 1}\n{"a"', b': 2}\n\n{"a": 3}') == [
+        (1, {"a": 1}),
+        (2, {"a": 2}),
+        (3, {"a": 3}),
+    ]
+
+
+def test_parse_ndjson_reports_invalid_lines_and_continues():
+    rows = parse(b'{"a": 1}\n{"a": \n{"a": 3}\n')
+    assert rows[0] == (1, {"a": 1})
+    assert rows[1][0] == 2 and rows[1][1].startswith("Invalid JSON")
+    assert rows[2] == (3, {"a": 3})
+
+
+def test_parse_json_array_split_across_chunks():
+    assert parse(b' [{"a": 1}, {"a"', b": 2},", b' {"a": "\xc3', b'\xa9"}]') == [
+        (1, {"a": 1}),
+        (2, {"a": 2}),
+        (3, {"a": "é"}),
+    ]
+
+
+def test_parse_json_array_stops_at_syntax_error():
+    assert parse(b'[{"a": 1} {"a": 2}]') == [(1, {"a": 1}), (2, "Expected ',' or ']'")]
+    assert parse(b'[{"a": 1}, {"a": 2}') == [
+        (1, {"a": 1}),
+        (2, {"a": 2}),
+        (3, "Unterminated JSON array"),
+    ]
+
+
+def test_parse_stops_at_documents_larger_than_the_limit():
+    assert parse(b'[{"a": "' + b"x" * 20, b'"}]', max_document_size=10) == [
+        (1, "Document is larger than 10 characters")
+    ]
+
+
+def test_parse_empty_input():
+    assert parse(b"") == []
+    assert parse(b"[]") == []